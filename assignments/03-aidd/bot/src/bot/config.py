@@ -1,6 +1,6 @@
 import os
 from dataclasses import dataclass
-from typing import Dict
+from typing import Dict, Optional
 
 
 TELEGRAM_TOKEN_ENV = "TELEGRAM_BOT_TOKEN"
@@ -8,7 +8,6 @@ OPENROUTER_KEY_ENV = "OPENROUTER_API_KEY"
 OPENROUTER_MODEL_ENV = "OPENROUTER_MODEL"
 DEFAULT_OPENROUTER_MODEL = "openai/gpt-oss-20b:free"
 
-
 @dataclass
 class Settings:
     telegram_token: str
@@ -18,20 +17,34 @@ class Settings:
 
     @classmethod
     def from_env(cls) -> "Settings":
-        """Load configuration from environment variables."""
+        """Load configuration from environment variables (parsed once per process)."""
+        global _cached
+        if _cached is not None:
+            return _cached
         telegram_token = os.environ[TELEGRAM_TOKEN_ENV]
         openrouter_key = os.environ[OPENROUTER_KEY_ENV]
-        openrouter_model = os.getenv(OPENROUTER_MODEL_ENV, DEFAULT_OPENROUTER_MODEL)
-        log_level = os.getenv("LOG_LEVEL", "INFO").upper()
-        return cls(
+        openrouter_model = (
+            os.getenv(OPENROUTER_MODEL_ENV, "").strip() or DEFAULT_OPENROUTER_MODEL
+        )
+        _cached = cls(
             telegram_token=telegram_token,
             openrouter_key=openrouter_key,
             openrouter_model=openrouter_model,
-            log_level=log_level,
+            log_level=os.getenv("LOG_LEVEL", "INFO").strip().upper(),
         )
+        return _cached
+
+    @classmethod
+    def invalidate(cls) -> None:
+        """Drop the cached settings so the next from_env() re-reads the environment."""
+        global _cached
+        _cached = None
 
     def public_info(self) -> Dict[str, str]:
         return {
             "openrouter_model": self.openrouter_model,
             "log_level": self.log_level,
         }
+
+
+_cached: Optional[Settings] = None
@@ -1,8 +1,17 @@
-from typing import Iterable, List, Tuple
+import asyncio
+import hashlib
+import re
+from collections import OrderedDict
+from itertools import islice
+from typing import AsyncIterator, Dict, List, Optional, Sequence
 
+import httpx
 from openai import AsyncOpenAI
 
 from .config import Settings
+from .memory import Message
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
 
 SYSTEM_PROMPT = (
     "You are an English language teacher. "
@@ -11,62 +20,135 @@ SYSTEM_PROMPT = (
     "use short paragraphs and simple bullet lists with hyphens when needed."
 )
 
+# Shared by every payload; the SDK only reads it, so never mutate it.
+_SYSTEM_MESSAGE: Message = {"role": "system", "content": SYSTEM_PROMPT}
+
+EMPTY_REPLY = "I'm still thinking about that."
+RESPONSE_CACHE_SIZE = 512
+
+_MD_EMPHASIS = re.compile(r"\*\*|__|```|`")
+_HEADING = re.compile(r"^[#\s]+")
+# Two pipes anywhere on the line; stops scanning at the second one.
+_TABLE_ROW = re.compile(r"\|[^|]*\|")
+
 
-Message = Tuple[str, str]
+def build_http_client() -> httpx.AsyncClient:
+    """Create the process-wide connection pool shared by all LLM calls."""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=200,
+            max_keepalive_connections=100,
+            keepalive_expiry=60.0,
+        ),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    )
+
+
+async def warm_up(http_client: httpx.AsyncClient) -> None:
+    """Open a keep-alive connection to OpenRouter before the first user message."""
+    try:
+        await http_client.head(OPENROUTER_BASE_URL)
+    except httpx.HTTPError:
+        pass
 
 
 class TutorLLM:
-    def __init__(self, settings: Settings) -> None:
+    def __init__(self, settings: Settings, http_client: httpx.AsyncClient) -> None:
         self._client = AsyncOpenAI(
             api_key=settings.openrouter_key,
-            base_url="https://openrouter.ai/api/v1",
+            base_url=OPENROUTER_BASE_URL,
+            http_client=http_client,
+            max_retries=2,
         )
         self._model = settings.openrouter_model
+        # Raw model output keyed by (model, normalized question, history).
+        self._cache: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Event] = {}
 
-    async def reply(self, user_message: str, history: List[Message]) -> str:
-        payload = [{"role": "system", "content": SYSTEM_PROMPT}]
-        for role, text in history:
-            payload.append({"role": role, "content": text})
-        payload.append({"role": "user", "content": user_message})
+    async def aclose(self) -> None:
+        """Close the OpenAI client together with its shared httpx pool."""
+        await self._client.close()
 
-        response = await self._client.responses.create(
-            model=self._model,
-            input=payload,
-        )
-        text = getattr(response, "output_text", None)
-        if text:
-            return self._to_plain_text(text)
-        raw = self._extract_text(response.output)
-        return self._to_plain_text(raw) if raw else "I'm still thinking about that."
+    async def reply(self, history: Sequence[Message]) -> str:
+        """Answer the last message of ``history``, which must be the user's turn."""
+        chunks = [delta async for delta in self.stream_reply(history)]
+        return self.finalize("".join(chunks))
+
+    async def stream_reply(self, history: Sequence[Message]) -> AsyncIterator[str]:
+        """Yield raw text deltas for the reply to the last (user) turn of ``history``."""
+        key = self._cache_key(history)
+        raw = await self._cached(key)
+        if raw is not None:
+            yield raw
+            return
+        done = self._inflight[key] = asyncio.Event()
+        try:
+            stream = await self._client.responses.create(
+                model=self._model,
+                input=self._build_payload(history),
+                stream=True,
+            )
+            chunks = []
+            async for event in stream:
+                if event.type == "response.output_text.delta":
+                    chunks.append(event.delta)
+                    yield event.delta
+            self._remember(key, "".join(chunks))
+        finally:
+            # A waiter that retried after a failed request may own the key by now.
+            if self._inflight.get(key) is done:
+                del self._inflight[key]
+            done.set()
+
+    async def _cached(self, key: str) -> Optional[str]:
+        # Identical concurrent questions wait for the first one instead of
+        # issuing their own request.
+        pending = self._inflight.get(key)
+        if pending is not None:
+            await pending.wait()
+        raw = self._cache.get(key)
+        if raw is not None:
+            self._cache.move_to_end(key)
+        return raw
+
+    def _remember(self, key: str, raw: str) -> None:
+        if not raw:
+            return
+        self._cache[key] = raw
+        if len(self._cache) > RESPONSE_CACHE_SIZE:
+            self._cache.popitem(last=False)
+
+    def _cache_key(self, history: Sequence[Message]) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(self._model.encode())
+        for message in islice(history, len(history) - 1):
+            digest.update(f"\0{message['role']}\0{message['content']}".encode())
+        normalized = " ".join(history[-1]["content"].lower().split())
+        digest.update(f"\0user\0{normalized}".encode())
+        return digest.hexdigest()
+
+    def finalize(self, raw: str) -> str:
+        """Turn accumulated raw model output into the final plain-text reply."""
+        return self._to_plain_text(raw) if raw else EMPTY_REPLY
 
     @staticmethod
-    def _extract_text(chunks: Iterable) -> str:
-        for chunk in chunks or []:
-            for part in getattr(chunk, "content", []) or []:
-                if getattr(part, "type", None) == "text":
-                    return part.text
-        return ""
+    def _build_payload(history: Sequence[Message]) -> List[Message]:
+        return [_SYSTEM_MESSAGE, *history]
 
     @staticmethod
     def _to_plain_text(text: str) -> str:
         if not text:
             return ""
-        cleaned = (
-            text.replace("**", "")
-            .replace("__", "")
-            .replace("```", "")
-            .replace("`", "")
-        )
-        lines = []
-        for line in cleaned.splitlines():
-            stripped = line.strip()
-            if not stripped:
-                lines.append("")
-                continue
-            if stripped.startswith("#"):
-                stripped = stripped.lstrip("# ").strip()
-            if "|" in stripped and stripped.count("|") >= 2:
-                cells = [cell.strip() for cell in stripped.strip("|").split("|")]
-                stripped = " | ".join(cell for cell in cells if cell)
-            lines.append(stripped)
-        return "\n".join(lines).strip()
+        cleaned = _MD_EMPHASIS.sub("", text)
+        return "\n".join(
+            TutorLLM._clean_line(line.strip()) for line in cleaned.splitlines()
+        ).strip()
+
+    @staticmethod
+    def _clean_line(stripped: str) -> str:
+        if stripped.startswith("#"):
+            stripped = _HEADING.sub("", stripped).strip()
+        if _TABLE_ROW.search(stripped):
+            cells = (cell.strip() for cell in stripped.strip("|").split("|"))
+            stripped = " | ".join(filter(None, cells))
+        return stripped
@@ -1,13 +1,18 @@
 import asyncio
 import logging
+import time
+import weakref
+from typing import Optional
+
 from aiogram import Bot, Dispatcher, F, types
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command
 
 from .config import Settings
-from .llm import TutorLLM
-from .memory import InMemoryDialogStore
+from .llm import TutorLLM, build_http_client, warm_up
+from .memory import InMemoryDialogStore, approx_tokens
 
 FALLBACK_REPLY = "Sorry, I had trouble answering. Please try again."
 WELCOME_MESSAGE = (
@@ -15,6 +20,28 @@ WELCOME_MESSAGE = (
     "and I'll do my best to help."
 )
 HELP_MESSAGE = "Ask questions about grammar, vocabulary, or practice dialogues."
+INVALID_MESSAGE_REPLY = "Please send a short English question."
+POLLING_TIMEOUT = 25
+STREAM_PLACEHOLDER = "…"
+# Telegram allows roughly one edit per second per chat; stay just below it.
+STREAM_EDIT_INTERVAL = 0.7
+
+
+logger = logging.getLogger("bot.main")
+
+
+async def edit_text(
+    message: types.Message, text: str, parse_mode: Optional[str] = None
+) -> None:
+    try:
+        await message.edit_text(text, parse_mode=parse_mode)
+    except TelegramBadRequest as exc:
+        if "message is not modified" in str(exc):
+            return
+        logger.warning("Failed to edit message: %s", exc)
+        if parse_mode is not None:
+            # Usually an HTML parse error (e.g. a literal "<"); send the text as is.
+            await edit_text(message, text, parse_mode=None)
 
 
 async def main() -> None:
@@ -23,7 +50,6 @@ async def main() -> None:
         level=settings.log_level,
         format="%(asctime)s %(levelname)s %(name)s: %(message)s",
     )
-    logger = logging.getLogger("bot.main")
 
     bot = Bot(
         token=settings.telegram_token,
@@ -31,8 +57,13 @@ async def main() -> None:
     )
     dp = Dispatcher()
 
-    llm = TutorLLM(settings=settings)
+    http_client = build_http_client()
+    llm = TutorLLM(settings=settings, http_client=http_client)
     memory = InMemoryDialogStore(limit=6)
+    # Entries disappear once no handler holds the lock, so idle users cost nothing.
+    user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = (
+        weakref.WeakValueDictionary()
+    )
 
     @dp.message(Command("start"))
     async def handle_start(message: types.Message) -> None:
@@ -43,40 +74,77 @@ async def main() -> None:
     async def handle_help(message: types.Message) -> None:
         await message.answer(HELP_MESSAGE)
 
-    @dp.message(F.text)
+    @dp.message(F.text.len() > 0)
     async def handle_message(message: types.Message) -> None:
+        user_text = message.text.strip()
+        # A message that eats most of the history budget would evict every
+        # earlier turn and leave no room for the answer.
+        if not user_text or approx_tokens(user_text) > memory.token_budget // 2:
+            await message.answer(INVALID_MESSAGE_REPLY)
+            return
         user = message.from_user
         user_id = user.id if user else message.chat.id
-        user_text = message.text or ""
-
-        prior_history = memory.get(user_id)
-        llm_history = [*prior_history, ("user", user_text)]
 
-        try:
-            reply = await llm.reply(user_message=user_text, history=llm_history)
-            memory.add(user_id, "user", user_text)
-            memory.add(user_id, "assistant", reply)
-        except Exception:
-            logger.exception("LLM request failed")
-            memory.add(user_id, "user", user_text)
-            reply = FALLBACK_REPLY
-        await message.answer(reply)
+        lock = user_locks.get(user_id)
+        if lock is None:
+            lock = user_locks[user_id] = asyncio.Lock()
+        # One LLM call per user at a time: keeps bursts from one chat off the
+        # shared pool and keeps the user/assistant turns in order.
+        async with lock:
+            # The user turn is stored up front; only the answer depends on the LLM.
+            history = memory.add(user_id, "user", user_text)
+            sent = await message.answer(STREAM_PLACEHOLDER, parse_mode=None)
+            chunks = []
+            last_edit = time.monotonic()
+            try:
+                async for delta in llm.stream_reply(history):
+                    chunks.append(delta)
+                    now = time.monotonic()
+                    if now - last_edit >= STREAM_EDIT_INTERVAL:
+                        # Partial output may contain unbalanced tags, so send it raw.
+                        await edit_text(sent, "".join(chunks))
+                        last_edit = now
+                reply = llm.finalize("".join(chunks))
+                memory.add(user_id, "assistant", reply)
+            except Exception:
+                logger.exception("LLM request failed")
+                reply = FALLBACK_REPLY
+            await edit_text(sent, reply, parse_mode=ParseMode.HTML)
 
     logger.info(
-        "Starting polling",
-        extra={
-            "openrouter_model": settings.openrouter_model,
-            "context_limit": memory.limit,
-        },
+        "Starting polling openrouter_model=%s context_limit=%d token_budget=%d",
+        settings.openrouter_model,
+        memory.limit,
+        memory.token_budget,
     )
 
     try:
-        await dp.start_polling(bot)
+        await warm_up(http_client)
+        # Skip the backlog accumulated while the bot was down.
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(
+            bot,
+            polling_timeout=POLLING_TIMEOUT,
+            allowed_updates=["message"],
+            handle_signals=True,
+        )
     except (KeyboardInterrupt, asyncio.CancelledError):
         logger.info("Bot shutdown requested")
     finally:
+        await llm.aclose()
         await bot.session.close()
 
 
+def run() -> None:
+    # uvloop is an optional speed-up (not a declared dependency, and not
+    # available on Windows); use it when it happens to be installed.
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
+
+
 if __name__ == "__main__":
-    asyncio.run(main())
+    run()
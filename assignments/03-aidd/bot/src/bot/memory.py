@@ -1,28 +1,50 @@
 from collections import deque
-from typing import Deque, Dict, List, Tuple
+from typing import Deque, Dict, Sequence
 
-Message = Tuple[str, str]
+# Stored in the exact shape the chat API expects, so the LLM payload can be
+# assembled from history without rebuilding a dict per turn.
+Message = Dict[str, str]
+
+DEFAULT_TOKEN_BUDGET = 2000
+
+
+def approx_tokens(text: str) -> int:
+    """Rough token estimate (~4 characters per token) used for history trimming."""
+    return len(text) // 4 + 1
 
 
 class InMemoryDialogStore:
-    def __init__(self, limit: int = 6) -> None:
+    def __init__(self, limit: int = 6, token_budget: int = DEFAULT_TOKEN_BUDGET) -> None:
         self._dialogs: Dict[int, Deque[Message]] = {}
+        self._tokens: Dict[int, int] = {}
         self._limit = limit
+        self._token_budget = token_budget
 
-    def add(self, user_id: int, role: str, text: str) -> List[Message]:
-        history = self._dialogs.setdefault(user_id, deque(maxlen=self._limit))
-        history.append((role, text))
-        return list(history)
+    def add(self, user_id: int, role: str, text: str) -> Sequence[Message]:
+        history = self._dialogs.setdefault(user_id, deque())
+        history.append({"role": role, "content": text})
+        total = self._tokens.get(user_id, 0) + approx_tokens(text)
+        # Evict the oldest turns until both the turn cap and the token budget
+        # hold; the newest turn is always kept.
+        while len(history) > 1 and (
+            len(history) > self._limit or total > self._token_budget
+        ):
+            total -= approx_tokens(history.popleft()["content"])
+        self._tokens[user_id] = total
+        return history
 
-    def get(self, user_id: int) -> List[Message]:
-        history = self._dialogs.get(user_id)
-        if not history:
-            return []
-        return list(history)
+    def get(self, user_id: int) -> Sequence[Message]:
+        """Return the live history; callers must only iterate it, not keep it."""
+        return self._dialogs.get(user_id) or ()
 
     def reset(self, user_id: int) -> None:
         self._dialogs.pop(user_id, None)
+        self._tokens.pop(user_id, None)
 
     @property
     def limit(self) -> int:
         return self._limit
+
+    @property
+    def token_budget(self) -> int:
+        return self._token_budget
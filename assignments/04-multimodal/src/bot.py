@@ -3,6 +3,7 @@ import logging
 from aiogram import Bot, Dispatcher
 from handlers import router
 from config import config
+from stt import close_stt_client
 
 logging.basicConfig(
     level=logging.INFO,
@@ -16,7 +17,10 @@ async def main():
     dp.include_router(router)
     
     logger.info("Starting bot...")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        await close_stt_client()
 
 if __name__ == "__main__":
     asyncio.run(main())
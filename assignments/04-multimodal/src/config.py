@@ -1,5 +1,8 @@
 import os
+from dataclasses import dataclass
+from functools import lru_cache
 from pathlib import Path
+from typing import Optional
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -7,8 +10,9 @@ load_dotenv()
 # Путь к корню проекта (где находится pyproject.toml)
 PROJECT_ROOT = Path(__file__).parent.parent
 
+@lru_cache(maxsize=None)
 def load_prompt(prompt_file_path: str, env_var: str = None) -> str:
-    """Загружает промпт из файла или переменной окружения."""
+    """Загружает промпт из файла или переменной окружения (один раз на пару аргументов)."""
     # Сначала пробуем загрузить из переменной окружения напрямую
     if env_var:
         env_value = os.getenv(env_var)
@@ -24,31 +28,69 @@ def load_prompt(prompt_file_path: str, env_var: str = None) -> str:
     # Если ничего не найдено, возвращаем пустую строку
     return ""
 
+@dataclass(frozen=True)
 class Config:
-    TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-    OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-    OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1")
-    MODEL_TEXT = os.getenv("MODEL_TEXT", os.getenv("MODEL"))  # Для обратной совместимости можно использовать MODEL
-    MODEL_IMAGE = os.getenv("MODEL_IMAGE")
+    TELEGRAM_TOKEN: Optional[str]
+    OPENAI_API_KEY: Optional[str]
+    OPENAI_BASE_URL: str
+    MODEL_TEXT: Optional[str]
+    MODEL_IMAGE: Optional[str]
     # STT / Speech-to-Text
-    STT_PROVIDER = os.getenv("STT_PROVIDER", "openai")  # openai | faster_whisper
-    STT_LANGUAGE = os.getenv("STT_LANGUAGE", "ru")
+    STT_PROVIDER: str  # openai | faster_whisper (в нижнем регистре)
+    STT_LANGUAGE: str
     # OpenAI STT specific
-    OPENAI_STT_API_KEY = os.getenv("OPENAI_STT_API_KEY", OPENAI_API_KEY)
-    OPENAI_AUDIO_BASE_URL = os.getenv("OPENAI_AUDIO_BASE_URL", OPENAI_BASE_URL)
-    STT_OPENAI_MODEL = os.getenv("STT_OPENAI_MODEL", "openai/whisper-1")
+    OPENAI_STT_API_KEY: Optional[str]
+    OPENAI_AUDIO_BASE_URL: str
+    STT_OPENAI_MODEL: str
     # faster-whisper specific
-    STT_LOCAL_MODEL = os.getenv("STT_LOCAL_MODEL", "small")
-    STT_DEVICE = os.getenv("STT_DEVICE", "cpu")  # cpu | cuda
-    STT_COMPUTE_TYPE = os.getenv("STT_COMPUTE_TYPE", "int8")  # float16|int8|int8_float16|...
-    STT_VAD = os.getenv("STT_VAD", "false")  # true|false — фильтрация тишины (требует зависимости у faster-whisper)
-    SYSTEM_PROMPT_TEXT = load_prompt(
-        os.getenv("SYSTEM_PROMPT_TEXT_PATH", "prompts/system_prompt_text.txt"),
-        "SYSTEM_PROMPT_TEXT"
-    )
-    SYSTEM_PROMPT_IMAGE = load_prompt(
-        os.getenv("SYSTEM_PROMPT_IMAGE_PATH", "prompts/system_prompt_image.txt"),
-        "SYSTEM_PROMPT_IMAGE"
+    STT_LOCAL_MODEL: str
+    STT_DEVICE: str  # cpu | cuda
+    STT_COMPUTE_TYPE: str  # float16|int8|int8_float16|...
+    STT_VAD: bool  # фильтрация тишины (требует зависимости у faster-whisper)
+    STT_WORKERS: int  # сколько распознаваний faster-whisper идут параллельно
+    STT_CPU_THREADS: int  # потоков CTranslate2 на одно распознавание
+    SYSTEM_PROMPT_TEXT: str
+    SYSTEM_PROMPT_IMAGE: str
+
+
+@lru_cache(maxsize=1)
+def get_config() -> Config:
+    """Читает переменные окружения и промпты один раз за процесс."""
+    openai_api_key = os.getenv("OPENAI_API_KEY")
+    openai_base_url = os.getenv("OPENAI_BASE_URL", "https://openrouter.ai/api/v1")
+    stt_device = os.getenv("STT_DEVICE") or "cpu"
+    cpu_count = os.cpu_count() or 1
+    stt_workers = max(1, int(os.getenv("STT_WORKERS") or min(4, cpu_count)))
+    return Config(
+        TELEGRAM_TOKEN=os.getenv("TELEGRAM_TOKEN"),
+        OPENAI_API_KEY=openai_api_key,
+        OPENAI_BASE_URL=openai_base_url,
+        MODEL_TEXT=os.getenv("MODEL_TEXT", os.getenv("MODEL")),  # Для обратной совместимости можно использовать MODEL
+        MODEL_IMAGE=os.getenv("MODEL_IMAGE"),
+        STT_PROVIDER=(os.getenv("STT_PROVIDER") or "openai").lower(),
+        STT_LANGUAGE=os.getenv("STT_LANGUAGE") or "ru",
+        OPENAI_STT_API_KEY=os.getenv("OPENAI_STT_API_KEY", openai_api_key),
+        OPENAI_AUDIO_BASE_URL=os.getenv("OPENAI_AUDIO_BASE_URL", openai_base_url),
+        STT_OPENAI_MODEL=os.getenv("STT_OPENAI_MODEL") or "openai/whisper-1",
+        STT_LOCAL_MODEL=os.getenv("STT_LOCAL_MODEL") or "small",
+        STT_DEVICE=stt_device,
+        # На GPU int8_float16 задействует тензорные ядра, на CPU — чистый int8
+        STT_COMPUTE_TYPE=os.getenv("STT_COMPUTE_TYPE")
+        or ("int8_float16" if stt_device == "cuda" else "int8"),
+        STT_VAD=os.getenv("STT_VAD", "false").lower() in ("1", "true", "yes", "on"),
+        STT_WORKERS=stt_workers,
+        STT_CPU_THREADS=int(
+            os.getenv("STT_CPU_THREADS") or max(1, cpu_count // stt_workers)
+        ),
+        SYSTEM_PROMPT_TEXT=load_prompt(
+            os.getenv("SYSTEM_PROMPT_TEXT_PATH", "prompts/system_prompt_text.txt"),
+            "SYSTEM_PROMPT_TEXT"
+        ),
+        SYSTEM_PROMPT_IMAGE=load_prompt(
+            os.getenv("SYSTEM_PROMPT_IMAGE_PATH", "prompts/system_prompt_image.txt"),
+            "SYSTEM_PROMPT_IMAGE"
+        ),
     )
 
-config = Config()
+
+config = get_config()
@@ -1,18 +1,21 @@
+import asyncio
+import functools
 import logging
 import re
 import base64
+import weakref
+from collections import OrderedDict
 from datetime import time
+from time import monotonic
 from aiogram import Router
 from aiogram.filters import Command
 from aiogram.types import Message
+from pydantic import TypeAdapter
 from openai import APIError, InternalServerError, NotFoundError
 from llm import get_transaction_response_text, get_transaction_response_image
-from models import Transaction
+from models import Transaction, TransactionResponse
 from config import config
 from stt import convert_to_wav, transcribe_audio
-import tempfile
-import os
-import shutil
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -21,21 +24,148 @@ router = Router()
 chat_conversations: dict[int, list[dict]] = {}
 transactions: dict[int, list[Transaction]] = {}
 
+# Агрегаты по транзакциям пользователя; обновляются инкрементально
+# в _add_transactions/_remove_last_transaction, а не пересчитываются
+income_totals: dict[int, float] = {}
+expense_totals: dict[int, float] = {}
+# категория -> [сумма со знаком, число транзакций]
+category_stats: dict[int, dict[str, list]] = {}
+
+# Сколько историй диалогов держим в памяти; у самых давно активных чатов
+# история вытесняется (транзакции и итоги пользователя не трогаем)
+MAX_ACTIVE_CHATS = 10_000
+# При превышении HISTORY_TRIM_AT сообщений в истории оставляем системный
+# промпт и последние HISTORY_KEEP (LLM всё равно получает только последние 10)
+HISTORY_TRIM_AT = 40
+HISTORY_KEEP = 30
+
 # Максимальная длина сообщения пользователя
 MAX_MESSAGE_LENGTH = 4000
+# Максимальная длина одной части отчёта /transactions
+REPORT_PART_LIMIT = 4000
+_MIDNIGHT = time(0, 0)
 
+# Ограничения исходящих сообщений: Telegram допускает ~30 сообщений/с на бота
+MAX_CONCURRENT_SENDS = 25
+SENDS_PER_SECOND = 25
 
-def _compute_balance(user_id: int) -> float:
-    return sum(
-        t.amount if t.type.value == "income" else -t.amount
-        for t in transactions.get(user_id, [])
+# Сколько тяжёлых вызовов (LLM/STT) выполняется одновременно на весь бот
+MAX_CONCURRENT_HEAVY_CALLS = 8
+
+# Шаблоны быстрых намерений, компилируются один раз при импорте
+_RE_REMOVE = re.compile(r"\b(удали|удалить|удалишь|убери|убрать|отмени|отменить)\b")
+_RE_LAST = re.compile(r"\bпоследн[а-я]+\b")
+_RE_LAST_TAIL = re.compile(r"последн[а-я]+\s+(.+)$")
+_RE_TRANSACTION_WORD = re.compile(r"^транзакц")
+_RE_SALARY = re.compile(r"\b(пришл[аио]|зарплат[аыуеы]|получил[аи]?)\b.*?(\d+[\d\s.,]*)")
+_RE_AMOUNT_TAIL = re.compile(r"[^0-9.].*$")
+_RE_WORDS = re.compile(r"[a-zа-яё0-9]+")
+# Подстроки-маркеры: регулярки выше запускаем, только если маркер есть в тексте
+_REMOVE_HINTS = ("удал", "убер", "убра", "отмен")
+_SALARY_HINTS = ("пришл", "зарплат", "получил")
+
+
+# Порядок последней активности чатов (LRU) для ограничения памяти
+_active_chats: OrderedDict[int, None] = OrderedDict()
+
+
+def _touch_chat(chat_id: int) -> None:
+    """
+    Отмечает активность чата и при переполнении вытесняет историю диалога
+    самого давно активного чата. Транзакции — данные пользователя, не кеш,
+    поэтому они не удаляются.
+    """
+    _active_chats[chat_id] = None
+    _active_chats.move_to_end(chat_id)
+    if len(_active_chats) > MAX_ACTIVE_CHATS:
+        stale_id, _ = _active_chats.popitem(last=False)
+        chat_conversations.pop(stale_id, None)
+
+
+def _conversation(chat_id: int) -> list[dict]:
+    """История чата; заново создаётся с системным промптом, если была вытеснена."""
+    return chat_conversations.setdefault(
+        chat_id, [{"role": "system", "content": config.SYSTEM_PROMPT_TEXT}]
     )
 
 
+def _append_history(chat_id: int, user_content: str, assistant_content: str) -> None:
+    history = _conversation(chat_id)
+    history.append({"role": "user", "content": user_content})
+    history.append({"role": "assistant", "content": assistant_content})
+    if len(history) > HISTORY_TRIM_AT:
+        del history[1:-HISTORY_KEEP]
+
+
+def _signed_amount(t: Transaction) -> float:
+    return t.amount if t.type.value == "income" else -t.amount
+
+
+def _track(user_id: int, t: Transaction, direction: int) -> None:
+    """Учесть (direction=1) или исключить (direction=-1) транзакцию из агрегатов."""
+    # Округляем до копеек, чтобы добавление/удаление не копило ошибку float
+    totals = income_totals if t.type.value == "income" else expense_totals
+    totals[user_id] = round(totals.get(user_id, 0.0) + direction * t.amount, 2)
+    stats = category_stats.setdefault(user_id, {})
+    entry = stats.setdefault(t.category, [0.0, 0])
+    entry[0] = round(entry[0] + direction * _signed_amount(t), 2)
+    entry[1] += direction
+    if entry[1] == 0:
+        del stats[t.category]
+
+
+def _add_transactions(user_id: int, new_transactions: list[Transaction]) -> None:
+    transactions.setdefault(user_id, []).extend(new_transactions)
+    for t in new_transactions:
+        _track(user_id, t, 1)
+
+
+def _reset_transactions(user_id: int) -> None:
+    transactions[user_id] = []
+    income_totals.pop(user_id, None)
+    expense_totals.pop(user_id, None)
+    category_stats.pop(user_id, None)
+
+
+def _compute_balance(user_id: int) -> float:
+    return round(income_totals.get(user_id, 0.0) - expense_totals.get(user_id, 0.0), 2)
+
+
+_TRANSACTIONS_ADAPTER = TypeAdapter(list[Transaction])
+
+
+def _dump_transactions(items: list[Transaction]) -> str:
+    """JSON транзакций для логов: одна сериализация в pydantic-core вместо model_dump() на каждую."""
+    return _TRANSACTIONS_ADAPTER.dump_json(items).decode()
+
+
+def _transaction_sort_key(t: Transaction) -> tuple:
+    return (t.date, t.time or _MIDNIGHT)
+
+
 def _format_balance(balance: float) -> str:
     return f"{balance:.0f}" if balance == int(balance) else f"{balance:.2f}"
 
 
+def _finalize_response(
+    chat_id: int,
+    history_content: str,
+    response: TransactionResponse,
+    prefix: str = "",
+) -> str:
+    """Сохраняет транзакции из ответа LLM, пишет историю и собирает текст ответа с балансом."""
+    if response.transactions:
+        _add_transactions(chat_id, response.transactions)
+        count = len(response.transactions)
+        status = f"✅ Найдено и сохранено {count} транзакция{'и' if count > 1 else ''}"
+    else:
+        status = "ℹ️ Транзакции не найдены"
+
+    _append_history(chat_id, history_content, response.answer)
+    balance = _format_balance(_compute_balance(chat_id))
+    return f"{prefix}{response.answer}\n\n{status}\n💵 Баланс: {balance} руб."
+
+
 def _remove_last_transaction(user_id: int, query: str | None = None) -> tuple[bool, str | None]:
     """Remove last transaction optionally matching a query.
 
@@ -48,35 +178,92 @@ def _remove_last_transaction(user_id: int, query: str | None = None) -> tuple[bo
     if query:
         q = query.strip().lower()
         stem4 = q[:4]
+        use_prefix = len(stem4) >= 3
+        short_q = q[:-1] if len(q) >= 5 else None
         for idx in range(len(user_tx) - 1, -1, -1):
             t = user_tx[idx]
-            hay = f"{t.category} {t.description}".lower()
-            words = re.findall(r"[a-zа-яё0-9]+", hay)
-            direct = q in hay
-            prefix = any(w.startswith(stem4) for w in words) if len(stem4) >= 3 else False
-            short = (len(q) >= 5 and q[:-1] in hay)
-            if direct or prefix or short:
+            hay = t._norm
+            # Сначала дешёвые проверки подстрок, токенизация — только если они не сработали
+            matched = (
+                q in hay
+                or (short_q is not None and short_q in hay)
+                or (use_prefix and any(w.startswith(stem4) for w in _RE_WORDS.findall(hay)))
+            )
+            if matched:
                 removed = user_tx.pop(idx)
-                transactions[user_id] = user_tx
+                _track(user_id, removed, -1)
                 return True, removed.category or removed.description or q
         return False, None
     else:
         removed = user_tx.pop()
-        transactions[user_id] = user_tx
+        _track(user_id, removed, -1)
         return True, removed.category or (removed.description[:30] if removed.description else None)
 
+# Сообщения одного чата обрабатываются строго по очереди (asyncio.Lock — FIFO),
+# разные чаты — параллельно; команды вроде /balance очередь не ждут.
+# Запись пропадает, когда замок никем не удерживается.
+_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+_heavy_calls = asyncio.Semaphore(MAX_CONCURRENT_HEAVY_CALLS)
+
+
+class _SendRateLimiter:
+    """Token bucket: не больше `rate` исходящих сообщений в секунду на весь бот."""
+
+    def __init__(self, rate: int):
+        self._rate = rate
+        self._tokens = float(rate)
+        self._updated = monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = monotonic()
+                self._tokens = min(self._rate, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+_send_slots = asyncio.Semaphore(MAX_CONCURRENT_SENDS)
+_send_limiter = _SendRateLimiter(SENDS_PER_SECOND)
+
+
+async def _safe_answer(message: Message, text: str):
+    """Отправляет ответ, ожидая своей очереди вместо flood wait от Telegram."""
+    async with _send_slots:
+        await _send_limiter.acquire()
+        return await message.answer(text)
+
+
+def _per_chat(handler):
+    """Выполняет обработчик в очереди своего чата."""
+    @functools.wraps(handler)
+    async def wrapper(message: Message):
+        lock = _chat_locks.get(message.chat.id)
+        if lock is None:
+            lock = _chat_locks[message.chat.id] = asyncio.Lock()
+        async with lock:
+            _touch_chat(message.chat.id)
+            return await handler(message)
+    return wrapper
+
 @router.message(Command("start"))
 async def cmd_start(message: Message):
     chat_id = message.chat.id
     logger.info(f"User {chat_id} started the bot")
     
     # Очищаем историю и транзакции для данного чата
+    _touch_chat(chat_id)
     chat_conversations[chat_id] = [
         {"role": "system", "content": config.SYSTEM_PROMPT_TEXT}
     ]
-    transactions[chat_id] = []
+    _reset_transactions(chat_id)
     
-    await message.answer(
+    await _safe_answer(
+        message,
         "Привет! Я персональный финансовый советник.\n\n"
         "Я могу:\n"
         "• Извлекать транзакции из ваших сообщений\n"
@@ -94,27 +281,20 @@ async def cmd_balance(message: Message):
     user_transactions = transactions.get(chat_id, [])
     
     if not user_transactions:
-        await message.answer(
+        await _safe_answer(
+            message,
             "💵 У вас пока нет транзакций.\n\n"
             "Отправьте сообщение с транзакцией или изображение чека для начала учета."
         )
         return
     
-    # Расчет баланса, доходов и расходов
-    total_income = sum(t.amount for t in user_transactions if t.type.value == "income")
-    total_expense = sum(t.amount for t in user_transactions if t.type.value == "expense")
-    balance = total_income - total_expense
-    
-    # Статистика по категориям
-    category_stats: dict[str, float] = {}
-    for t in user_transactions:
-        category = t.category
-        if category not in category_stats:
-            category_stats[category] = 0.0
-        if t.type.value == "income":
-            category_stats[category] += t.amount
-        else:
-            category_stats[category] -= t.amount
+    # Баланс, доходы, расходы и статистика по категориям уже посчитаны
+    total_income = income_totals.get(chat_id, 0.0)
+    total_expense = expense_totals.get(chat_id, 0.0)
+    balance = _compute_balance(chat_id)
+    user_category_stats = {
+        category: amount for category, (amount, _count) in category_stats.get(chat_id, {}).items()
+    }
     
     # Форматирование отчета
     report_lines = [
@@ -127,12 +307,12 @@ async def cmd_balance(message: Message):
     ]
     
     # Сортируем категории по сумме (от большей к меньшей)
-    sorted_categories = sorted(category_stats.items(), key=lambda x: abs(x[1]), reverse=True)
+    sorted_categories = sorted(user_category_stats.items(), key=lambda x: abs(x[1]), reverse=True)
     for category, amount in sorted_categories:
         sign = "💰" if amount > 0 else "💸"
         report_lines.append(f"{sign} {category}: {amount:+.2f} руб.")
     
-    await message.answer("\n".join(report_lines))
+    await _safe_answer(message, "\n".join(report_lines))
 
 @router.message(Command("transactions"))
 async def cmd_transactions(message: Message):
@@ -143,19 +323,22 @@ async def cmd_transactions(message: Message):
     user_transactions = transactions.get(chat_id, [])
     
     if not user_transactions:
-        await message.answer(
+        await _safe_answer(
+            message,
             "📋 У вас пока нет транзакций.\n\n"
             "Отправьте сообщение с транзакцией или изображение чека для начала учета."
         )
         return
     
     # Сортируем транзакции по дате (от новых к старым)
-    sorted_transactions = sorted(user_transactions, key=lambda t: (t.date, t.time or time(0, 0)), reverse=True)
+    sorted_transactions = sorted(user_transactions, key=_transaction_sort_key, reverse=True)
     
-    # Форматирование списка транзакций
-    report_lines = [
-        f"📋 **Все транзакции** ({len(user_transactions)} шт.)\n"
-    ]
+    # Форматирование списка транзакций сразу с разбиением на сообщения
+    # (Telegram лимит ~4096 символов): каждая часть склеивается один раз
+    header = f"📋 **Все транзакции** ({len(user_transactions)} шт.)\n"
+    parts = []
+    current_part = [header]
+    current_length = len(header)
     
     for i, t in enumerate(sorted_transactions, 1):
         # Форматирование даты и времени
@@ -172,40 +355,26 @@ async def cmd_transactions(message: Message):
         # Описание (если есть)
         desc_str = f"\n   {t.description}" if t.description else ""
         
-        report_lines.append(
+        line = (
             f"{i}. {sign} **{type_str}** {amount_str} руб.\n"
             f"   📅 {date_str}{time_str}\n"
             f"   🏷️ {t.category}{desc_str}"
         )
-    
-    # Если транзакций много, разбиваем на несколько сообщений (Telegram лимит ~4096 символов)
-    report_text = "\n\n".join(report_lines)
-    if len(report_text) > 4000:
-        # Разбиваем на части
-        parts = []
-        current_part = [report_lines[0]]  # Заголовок
-        current_length = len(report_lines[0])
-        
-        for line in report_lines[1:]:
-            line_length = len(line) + 2  # +2 для "\n\n"
-            if current_length + line_length > 4000:
-                parts.append("\n\n".join(current_part))
-                current_part = [line]
-                current_length = len(line)
-            else:
-                current_part.append(line)
-                current_length += line_length
-        
-        if current_part:
+        line_length = len(line) + 2  # +2 для "\n\n"
+        if current_length + line_length > REPORT_PART_LIMIT:
             parts.append("\n\n".join(current_part))
-        
-        # Отправляем части
-        for part in parts:
-            await message.answer(part)
-    else:
-        await message.answer(report_text)
+            current_part = [line]
+            current_length = len(line)
+        else:
+            current_part.append(line)
+            current_length += line_length
+    
+    parts.append("\n\n".join(current_part))
+    for part in parts:
+        await _safe_answer(message, part)
 
 @router.message(lambda message: message.photo or (message.document and message.document.mime_type and message.document.mime_type.startswith("image/")))
+@_per_chat
 async def handle_image(message: Message):
     chat_id = message.chat.id
     
@@ -226,7 +395,7 @@ async def handle_image(message: Message):
         elif message.document:
             file_info = await message.bot.get_file(message.document.file_id)
         else:
-            await message.answer("Не удалось обработать изображение.")
+            await _safe_answer(message, "Не удалось обработать изображение.")
             return
         
         # Скачиваем изображение
@@ -237,60 +406,30 @@ async def handle_image(message: Message):
         image_base64 = base64.b64encode(image_bytes).decode('utf-8')
         
         # Получаем историю сообщений без системного промпта для контекста
-        message_history = chat_conversations[chat_id][1:] if chat_conversations[chat_id] else []
+        message_history = _conversation(chat_id)[1:]
         
         # Получаем ответ LLM с structured output
-        response = await get_transaction_response_image(image_base64, message_history)
+        async with _heavy_calls:
+            response = await get_transaction_response_image(image_base64, message_history)
         
         # Детальное логирование ответа LLM
         logger.info(f"LLM response for image from {chat_id}: answer='{response.answer[:200]}...', transactions_count={len(response.transactions)}")
         if response.transactions:
-            logger.info(f"Extracted {len(response.transactions)} transactions from image for {chat_id}: {[t.model_dump() for t in response.transactions]}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"Extracted {len(response.transactions)} transactions from image for {chat_id}: {_dump_transactions(response.transactions)}")
         else:
             logger.warning(f"No transactions extracted from image for {chat_id}")
         
-        # Сохраняем транзакции
-        if response.transactions:
-            if chat_id not in transactions:
-                transactions[chat_id] = []
-            transactions[chat_id].extend(response.transactions)
-        
-        # Рассчитываем баланс
-        balance = sum(
-            t.amount if t.type.value == "income" else -t.amount 
-            for t in transactions.get(chat_id, [])
-        )
-        
-        # Формируем ответ пользователю
-        answer_text = response.answer
-        
-        # Добавляем статус транзакций
-        if response.transactions:
-            count = len(response.transactions)
-            answer_text += f"\n\n✅ Найдено и сохранено {count} транзакция{'и' if count > 1 else ''}"
-        else:
-            answer_text += "\n\nℹ️ Транзакции не найдены"
-        
-        # Добавляем баланс
-        balance_str = f"{balance:.0f}" if balance == int(balance) else f"{balance:.2f}"
-        answer_text += f"\n💵 Баланс: {balance_str} руб."
-        
-        # Добавляем изображение в историю как текстовое описание (для контекста)
-        chat_conversations[chat_id].append(
-            {"role": "user", "content": "[Изображение: чек/скриншот]"}
-        )
-        
-        # Добавляем ответ LLM в историю
-        chat_conversations[chat_id].append(
-            {"role": "assistant", "content": response.answer}
-        )
-        
-        await message.answer(answer_text)
+        # Сохраняем транзакции и собираем ответ; изображение попадает в историю
+        # как текстовое описание (для контекста) вместе с ответом LLM
+        answer_text = _finalize_response(chat_id, "[Изображение: чек/скриншот]", response)
+        await _safe_answer(message, answer_text)
     except (APIError, InternalServerError, NotFoundError) as e:
         logger.error(f"LLM API error for image from {chat_id}: {e}", exc_info=True)
         error_message = str(e)
         if "image input" in error_message.lower() or "404" in error_message or "not found" in error_message.lower():
-            await message.answer(
+            await _safe_answer(
+                message,
                 "Извините, используемая модель не поддерживает обработку изображений.\n\n"
                 "Для работы с изображениями необходимо использовать vision-модель, например:\n"
                 "• meta-llama/llama-3.2-11b-vision-instruct (OpenRouter)\n"
@@ -298,18 +437,21 @@ async def handle_image(message: Message):
                 "Измените MODEL в файле .env на одну из этих моделей."
             )
         else:
-            await message.answer(
+            await _safe_answer(
+                message,
                 "Извините, произошла ошибка на стороне провайдера LLM при обработке изображения. "
                 "Пожалуйста, попробуйте еще раз через несколько секунд."
             )
     except Exception as e:
         logger.error(f"Error processing image from {chat_id}: {e}", exc_info=True)
-        await message.answer(
+        await _safe_answer(
+            message,
             "Произошла ошибка при обработке изображения. "
             "Попробуйте еще раз или используйте /start для начала нового диалога."
         )
 
 @router.message(lambda message: message.voice or message.audio)
+@_per_chat
 async def handle_voice(message: Message):
     chat_id = message.chat.id
     logger.info(f"Voice/audio message received from {chat_id}")
@@ -320,10 +462,6 @@ async def handle_voice(message: Message):
             {"role": "system", "content": config.SYSTEM_PROMPT_TEXT}
         ]
 
-    tmpdir = tempfile.mkdtemp(prefix="tg-voice-")
-    src_path = os.path.join(tmpdir, "input.ogg")
-    wav_path = os.path.join(tmpdir, "output.wav")
-
     try:
         # Получаем файл
         if message.voice:
@@ -331,87 +469,68 @@ async def handle_voice(message: Message):
         elif message.audio:
             file_info = await message.bot.get_file(message.audio.file_id)
         else:
-            await message.answer("Не удалось обработать голосовое сообщение.")
+            await _safe_answer(message, "Не удалось обработать голосовое сообщение.")
             return
 
         file_buffer = await message.bot.download_file(file_info.file_path)
-        with open(src_path, "wb") as f:
-            f.write(file_buffer.getvalue())
 
-        # Конвертация в WAV 16kHz mono
-        await convert_to_wav(src_path, wav_path)
+        # Конвертация в WAV 16kHz mono: голосовые (OGG/Opus) через pipe ffmpeg,
+        # аудиофайлы (m4a/MP4 и т.п.) через временный файл
+        wav = await convert_to_wav(file_buffer.getvalue(), seekable=message.voice is None)
 
         # Транскрибация в текст
-        text = await transcribe_audio(wav_path)
+        async with _heavy_calls:
+            text = await transcribe_audio(wav)
         if not text:
-            await message.answer("Не удалось распознать речь на аудио.")
+            await _safe_answer(message, "Не удалось распознать речь на аудио.")
             return
 
         logger.info(f"Transcribed voice from {chat_id}: {text[:120]}...")
 
         # Подготовка истории для контекста
-        message_history = chat_conversations[chat_id][1:] if chat_conversations[chat_id] else []
+        message_history = _conversation(chat_id)[1:]
 
         # Запрашиваем structured output по распознанному тексту
-        response = await get_transaction_response_text(text, message_history)
+        async with _heavy_calls:
+            response = await get_transaction_response_text(text, message_history)
 
-        # Сохраняем транзакции
-        if response.transactions:
-            if chat_id not in transactions:
-                transactions[chat_id] = []
-            transactions[chat_id].extend(response.transactions)
-
-        # Рассчитываем баланс
-        balance = sum(
-            t.amount if t.type.value == "income" else -t.amount
-            for t in transactions.get(chat_id, [])
+        # Сохраняем транзакции, обновляем историю и собираем ответ
+        answer_text = _finalize_response(
+            chat_id, text, response, prefix=f"🗣️ Распознал текст:\n{text}\n\n"
         )
-
-        # Собираем ответ
-        answer_text = f"🗣️ Распознал текст:\n{text}\n\n" + response.answer
-        if response.transactions:
-            count = len(response.transactions)
-            answer_text += f"\n\n✅ Найдено и сохранено {count} транзакция{'и' if count > 1 else ''}"
-        else:
-            answer_text += "\n\nℹ️ Транзакции не найдены"
-
-        balance_str = f"{balance:.0f}" if balance == int(balance) else f"{balance:.2f}"
-        answer_text += f"\n💵 Баланс: {balance_str} руб."
-
-        # Обновляем историю диалога
-        chat_conversations[chat_id].append({"role": "user", "content": text})
-        chat_conversations[chat_id].append({"role": "assistant", "content": response.answer})
-
-        await message.answer(answer_text)
+        await _safe_answer(message, answer_text)
 
     except FileNotFoundError as e:
         logger.error(f"ffmpeg not found for {chat_id}: {e}")
-        await message.answer(
+        await _safe_answer(
+            message,
             "Не удалось конвертировать аудио. Убедитесь, что установлен ffmpeg (macOS: brew install ffmpeg, Ubuntu/Debian: apt-get install ffmpeg)."
         )
     except (APIError, InternalServerError) as e:
         logger.error(f"LLM/STT API error for {chat_id}: {e}", exc_info=True)
-        await message.answer(
+        await _safe_answer(
+            message,
             "Извините, произошла ошибка при распознавании речи/обработке текста. Попробуйте еще раз."
         )
     except Exception as e:
         logger.error(f"Error processing voice/audio from {chat_id}: {e}", exc_info=True)
-        await message.answer(
+        await _safe_answer(
+            message,
             "Произошла ошибка при обработке голосового сообщения. Попробуйте еще раз."
         )
-    finally:
-        shutil.rmtree(tmpdir, ignore_errors=True)
 
 @router.message()
+@_per_chat
 async def handle_message(message: Message):
     # Игнорируем сообщения без текста
     if not message.text:
-        await message.answer("Извините, я работаю только с текстовыми сообщениями.")
+        await _safe_answer(message, "Извините, я работаю только с текстовыми сообщениями.")
         return
     
     # Проверяем длину сообщения
     if len(message.text) > MAX_MESSAGE_LENGTH:
-        await message.answer(
+        await _safe_answer(
+            message,
             f"Извините, ваше сообщение слишком длинное ({len(message.text)} символов). "
             f"Максимальная длина: {MAX_MESSAGE_LENGTH} символов."
         )
@@ -429,20 +548,22 @@ async def handle_message(message: Message):
         ]
     
     # Получаем историю сообщений без системного промпта для контекста
-    message_history = chat_conversations[chat_id][1:] if chat_conversations[chat_id] else []
+    message_history = _conversation(chat_id)[1:]
 
     # Быстрые намерения до вызова LLM
     normalized = last_message.lower().strip()
 
     # 1) Удаление последней транзакции (по категории/описанию или без уточнения)
-    remove_intent = re.search(r"\b(удали|удалить|удалишь|убери|убрать|отмени|отменить)\b", normalized)
-    last_token = re.search(r"\bпоследн[а-я]+\b", normalized)
-    if remove_intent and last_token:
+    if (
+        any(hint in normalized for hint in _REMOVE_HINTS)
+        and _RE_REMOVE.search(normalized)
+        and _RE_LAST.search(normalized)
+    ):
         # Попробуем извлечь уточнение после слова 'последн*'
-        m = re.search(r"последн[а-я]+\s+(.+)$", normalized)
+        m = _RE_LAST_TAIL.search(normalized)
         query = m.group(1).strip() if m else None
         # Если уточнение похоже на слово 'транзакц*', не используем его
-        if query and re.match(r"^транзакц", query):
+        if query and _RE_TRANSACTION_WORD.match(query):
             query = None
 
         removed, key = _remove_last_transaction(chat_id, query)
@@ -461,20 +582,23 @@ async def handle_message(message: Message):
                 f"💵 Баланс: {_format_balance(balance)} руб."
             )
 
-        chat_conversations[chat_id].append({"role": "user", "content": last_message})
-        chat_conversations[chat_id].append({"role": "assistant", "content": answer_text})
-        await message.answer(answer_text)
+        _append_history(chat_id, last_message, answer_text)
+        await _safe_answer(message, answer_text)
         return
 
     # 2) Явный доход: "пришла зарплата 54321", "зарплата 120000"
-    salary_match = re.search(r"\b(пришл[аио]|зарплат[аыуеы]|получил[аи]?)\b.*?(\d+[\d\s.,]*)", normalized)
+    salary_match = (
+        _RE_SALARY.search(normalized)
+        if any(hint in normalized for hint in _SALARY_HINTS)
+        else None
+    )
     if salary_match:
         from datetime import date
         from models import Transaction, TransactionType, TransactionFrequency
 
         raw_amount = salary_match.group(2)
         amt = raw_amount.replace(" ", "").replace(",", ".")
-        amt = re.sub(r"[^0-9.].*$", "", amt)
+        amt = _RE_AMOUNT_TAIL.sub("", amt)
         try:
             amount = float(amt)
         except ValueError:
@@ -490,9 +614,7 @@ async def handle_message(message: Message):
                 category="зарплата",
                 description="Зарплата"
             )
-            if chat_id not in transactions:
-                transactions[chat_id] = []
-            transactions[chat_id].append(tx)
+            _add_transactions(chat_id, [tx])
 
             balance = _compute_balance(chat_id)
             answer_text = (
@@ -500,68 +622,37 @@ async def handle_message(message: Message):
                 f"✅ Найдено и сохранено 1 транзакция\n"
                 f"💵 Баланс: {_format_balance(balance)} руб."
             )
-            chat_conversations[chat_id].append({"role": "user", "content": last_message})
-            chat_conversations[chat_id].append({"role": "assistant", "content": "Записал ваш доход: зарплата."})
-            await message.answer(answer_text)
+            _append_history(chat_id, last_message, "Записал ваш доход: зарплата.")
+            await _safe_answer(message, answer_text)
             return
 
     try:
         # Получаем ответ LLM с structured output (извлечение транзакций только из последнего сообщения)
-        response = await get_transaction_response_text(last_message, message_history)
+        async with _heavy_calls:
+            response = await get_transaction_response_text(last_message, message_history)
         
         # Детальное логирование ответа LLM
         logger.info(f"LLM response for {chat_id}: answer='{response.answer[:200]}...', transactions_count={len(response.transactions)}")
         if response.transactions:
-            logger.info(f"Extracted {len(response.transactions)} transactions for {chat_id}: {[t.model_dump() for t in response.transactions]}")
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(f"Extracted {len(response.transactions)} transactions for {chat_id}: {_dump_transactions(response.transactions)}")
         else:
             logger.warning(f"No transactions extracted from message: '{last_message}' for {chat_id}")
         
-        # Сохраняем транзакции
-        if response.transactions:
-            if chat_id not in transactions:
-                transactions[chat_id] = []
-            transactions[chat_id].extend(response.transactions)
-        
-        # Рассчитываем баланс
-        balance = sum(
-            t.amount if t.type.value == "income" else -t.amount 
-            for t in transactions.get(chat_id, [])
-        )
-        
-        # Формируем ответ пользователю
-        answer_text = response.answer
-        
-        # Добавляем статус транзакций
-        if response.transactions:
-            count = len(response.transactions)
-            answer_text += f"\n\n✅ Найдено и сохранено {count} транзакция{'и' if count > 1 else ''}"
-        else:
-            answer_text += "\n\nℹ️ Транзакции не найдены"
-        
-        # Добавляем баланс
-        balance_str = f"{balance:.0f}" if balance == int(balance) else f"{balance:.2f}"
-        answer_text += f"\n💵 Баланс: {balance_str} руб."
-        
-        # Добавляем сообщение пользователя в историю
-        chat_conversations[chat_id].append(
-            {"role": "user", "content": last_message}
-        )
-        
-        # Добавляем ответ LLM в историю
-        chat_conversations[chat_id].append(
-            {"role": "assistant", "content": response.answer}
-        )
-        
-        await message.answer(answer_text)
+        # Сохраняем транзакции, добавляем сообщение и ответ LLM в историю
+        answer_text = _finalize_response(chat_id, last_message, response)
+        await _safe_answer(message, answer_text)
     except (APIError, InternalServerError) as e:
         logger.error(f"LLM API error for {chat_id}: {e}", exc_info=True)
-        await message.answer(
+        await _safe_answer(
+            message,
             "Извините, произошла ошибка на стороне провайдера LLM. "
             "Пожалуйста, попробуйте еще раз через несколько секунд."
         )
     except Exception as e:
         logger.error(f"Error in handle_message for {chat_id}: {e}", exc_info=True)
-        await message.answer(
+        await _safe_answer(
+            message,
             "Произошла ошибка при обработке вашего сообщения. "
             "Попробуйте еще раз или используйте /start для начала нового диалога."
         )
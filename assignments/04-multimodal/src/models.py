@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from datetime import date, time
 from enum import Enum
 from typing import Optional
@@ -20,6 +20,11 @@ class Transaction(BaseModel):
     frequency: TransactionFrequency       # тип (повседневные, периодические, разовые)
     category: str                        # категория (продукты, рестораны, такси и т.д.)
     description: str = ""                # описание транзакции (подробная информация о товарах, услугах, источнике, контрагенте и т.п.)
+    # "категория описание" в нижнем регистре для поиска при удалении; не сериализуется
+    _norm: str = PrivateAttr(default="")
+
+    def model_post_init(self, __context) -> None:
+        self._norm = f"{self.category} {self.description}".lower()
 
 class TransactionResponse(BaseModel):
     transactions: list[Transaction]  # список транзакций (всегда должен быть, пустой [] если не найдено)
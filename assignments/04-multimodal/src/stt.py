@@ -1,7 +1,10 @@
 import asyncio
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
 import shutil
 import subprocess
+import tempfile
 from typing import Optional
 
 from config import config
@@ -16,65 +19,112 @@ def _ensure_ffmpeg() -> str:
     return path
 
 
-async def convert_to_wav(input_path: str, output_path: str, sample_rate: int = 16000) -> None:
+class FFmpegError(subprocess.CalledProcessError):
+    """Ошибка ffmpeg с хвостом его stderr в тексте исключения."""
+
+    def __str__(self) -> str:
+        details = (self.stderr or b"").decode("utf-8", errors="replace").strip()
+        return f"{super().__str__()} {details[-500:]}" if details else super().__str__()
+
+
+def _write_temp_audio(audio: bytes) -> str:
+    fd, path = tempfile.mkstemp(suffix=".audio")
+    with os.fdopen(fd, "wb") as f:
+        f.write(audio)
+    return path
+
+
+async def convert_to_wav(audio: bytes, sample_rate: int = 16000, seekable: bool = False) -> bytes:
+    """
+    Конвертирует аудио в WAV 16kHz mono через ffmpeg.
+
+    По умолчанию вход подаётся в stdin (подходит для голосовых OGG/Opus).
+    seekable=True пишет вход во временный файл: контейнерам вроде m4a/MP4
+    с moov-атомом в конце нужен произвольный доступ, из pipe они не читаются.
+    """
     ffmpeg = _ensure_ffmpeg()
+    input_path = await asyncio.to_thread(_write_temp_audio, audio) if seekable else None
     cmd = [
         ffmpeg,
-        "-y",
         "-i",
-        input_path,
+        input_path or "pipe:0",
         "-ar",
         str(sample_rate),
         "-ac",
         "1",
         "-c:a",
         "pcm_s16le",
-        output_path,
+        "-f",
+        "wav",
+        "pipe:1",
     ]
-    # Выполняем преобразование в отдельном потоке, чтобы не блокировать event loop
-    def _run():
-        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
-    await asyncio.to_thread(_run)
+    try:
+        # Дочерний процесс работает с event loop напрямую, не занимая поток из пула
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL if input_path else asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        wav, err = await proc.communicate(None if input_path else audio)
+    finally:
+        if input_path:
+            os.unlink(input_path)
+    if proc.returncode != 0:
+        raise FFmpegError(proc.returncode, cmd, stderr=err)
+    return wav
 
 
-async def transcribe_audio(path_wav: str) -> str:
-    provider = (config.STT_PROVIDER or "openai").lower()
+async def transcribe_audio(wav: bytes) -> str:
+    provider = config.STT_PROVIDER
     if provider == "openai":
-        return await _transcribe_openai(path_wav)
+        return await _transcribe_openai(wav)
     elif provider in {"faster_whisper", "faster-whisper", "local"}:
-        return await _transcribe_faster_whisper(path_wav)
+        return await _transcribe_faster_whisper(wav)
     else:
         raise ValueError(f"Неизвестный STT_PROVIDER: {config.STT_PROVIDER}")
 
 
-async def _transcribe_openai(path_wav: str) -> str:
-    # Локальный клиент с отдельной базой/ключом для STT (может отличаться от чата)
-    from openai import AsyncOpenAI, APIStatusError
+_stt_client = None
+
+
+def _get_stt_client():
+    """Один клиент (и пул соединений) на процесс для всех транскрибаций."""
+    global _stt_client
+    if _stt_client is None:
+        import httpx
+        from openai import AsyncOpenAI
+
+        # Отдельная база/ключ для STT (может отличаться от чата)
+        _stt_client = AsyncOpenAI(
+            api_key=config.OPENAI_STT_API_KEY,
+            base_url=config.OPENAI_AUDIO_BASE_URL,
+            http_client=httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+            ),
+        )
+    return _stt_client
 
-    client = AsyncOpenAI(
-        api_key=config.OPENAI_STT_API_KEY,
-        base_url=config.OPENAI_AUDIO_BASE_URL,
-    )
-    model = config.STT_OPENAI_MODEL or "whisper-1"
 
-    def _call():
-        with open(path_wav, "rb") as f:
-            return f.read()
+async def close_stt_client() -> None:
+    global _stt_client
+    if _stt_client is not None:
+        await _stt_client.close()
+        _stt_client = None
 
-    data = await asyncio.to_thread(_call)
 
-    # Оборачиваем в BytesIO для передачи без повторного открытия
-    import io
+async def _transcribe_openai(wav: bytes) -> str:
+    from openai import APIStatusError
 
-    fileobj = io.BytesIO(data)
-    fileobj.name = os.path.basename(path_wav)
+    client = _get_stt_client()
+    model = config.STT_OPENAI_MODEL
 
     try:
         resp = await client.audio.transcriptions.create(
             model=model,
-            file=fileobj,
-            language=config.STT_LANGUAGE or "ru",
+            # Байты из ffmpeg отдаём SDK как есть, с явными именем и MIME-типом
+            file=("audio.wav", wav, "audio/wav"),
+            language=config.STT_LANGUAGE,
         )
         return (resp.text or "").strip()
     except APIStatusError as e:
@@ -89,10 +139,14 @@ async def _transcribe_openai(path_wav: str) -> str:
 
 
 _fw_model = None
+# Отдельный пул под faster-whisper: распознавания не занимают слоты
+# стандартного executor'а, а параллелизм совпадает с num_workers модели
+_fw_executor = ThreadPoolExecutor(
+    max_workers=config.STT_WORKERS, thread_name_prefix="faster-whisper"
+)
 
 
-async def _transcribe_faster_whisper(path_wav: str) -> str:
-    global _fw_model
+async def _transcribe_faster_whisper(wav: bytes) -> str:
     try:
         from faster_whisper import WhisperModel  # type: ignore
     except Exception as e:  # pragma: no cover
@@ -104,22 +158,24 @@ async def _transcribe_faster_whisper(path_wav: str) -> str:
         global _fw_model
         if _fw_model is None:
             _fw_model = WhisperModel(
-                config.STT_LOCAL_MODEL or "small",
-                device=config.STT_DEVICE or "cpu",
-                compute_type=config.STT_COMPUTE_TYPE or "int8",
+                config.STT_LOCAL_MODEL,
+                device=config.STT_DEVICE,
+                compute_type=config.STT_COMPUTE_TYPE,
+                cpu_threads=config.STT_CPU_THREADS,
+                num_workers=config.STT_WORKERS,
             )
         return _fw_model
 
-    model = await asyncio.to_thread(_ensure_model)
+    loop = asyncio.get_running_loop()
+    model = await loop.run_in_executor(_fw_executor, _ensure_model)
 
     def _run_transcribe():
-        vad = str(config.STT_VAD or "false").lower() in ("1", "true", "yes", "on")
         segments, _info = model.transcribe(
-            path_wav,
-            language=config.STT_LANGUAGE or "ru",
-            vad_filter=vad,
+            io.BytesIO(wav),
+            language=config.STT_LANGUAGE,
+            vad_filter=config.STT_VAD,
             beam_size=5,
         )
         return "".join(seg.text for seg in segments).strip()
 
-    return await asyncio.to_thread(_run_transcribe)
+    return await loop.run_in_executor(_fw_executor, _run_transcribe)
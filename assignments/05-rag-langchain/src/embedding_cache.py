@@ -0,0 +1,94 @@
+import hashlib
+import logging
+import sqlite3
+from array import array
+from pathlib import Path
+from typing import List
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Обёртка над эмбеддингами с локальным кешем в SQLite.
+    Ключ — модель и хеш текста чанка, поэтому при переиндексации
+    неизменённых документов запросы к API не отправляются.
+    Эмбеддинги запросов не кешируются.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, path: str):
+        self.underlying = underlying
+        self.model_name = model_name
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+
+    def close(self) -> None:
+        """Закрывает соединение с кешем; эмбеддинги запросов работают и после этого."""
+        self._db.close()
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+        return f"{self.model_name}:{digest}"
+
+    def _lookup(self, keys: List[str]) -> dict:
+        found = {}
+        # Ограничение SQLite на число параметров в одном запросе
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            placeholders = ",".join("?" * len(part))
+            rows = self._db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", part
+            )
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+        return found
+
+    def _store(self, keys: List[str], vectors: List[List[float]]) -> None:
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(key, array("f", vector).tobytes()) for key, vector in zip(keys, vectors)],
+            )
+
+    def _split(self, texts: List[str]) -> tuple:
+        keys = [self._key(text) for text in texts]
+        cached = self._lookup(list(set(keys)))
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        return keys, cached, missing
+
+    def _merge(self, keys, cached, missing, new_vectors) -> List[List[float]]:
+        self._store([keys[i] for i in missing], new_vectors)
+        for i, vector in zip(missing, new_vectors):
+            cached[keys[i]] = vector
+        logger.info(
+            f"Embedding cache: {len(keys) - len(missing)} hits, {len(missing)} misses"
+        )
+        return [cached[key] for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = self._split(texts)
+        new_vectors = (
+            self.underlying.embed_documents([texts[i] for i in missing]) if missing else []
+        )
+        return self._merge(keys, cached, missing, new_vectors)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, cached, missing = self._split(texts)
+        new_vectors = (
+            await self.underlying.aembed_documents([texts[i] for i in missing])
+            if missing
+            else []
+        )
+        return self._merge(keys, cached, missing, new_vectors)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.underlying.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await self.underlying.aembed_query(text)
@@ -1,18 +1,50 @@
 import logging
 from difflib import SequenceMatcher
-from typing import List, Optional
+from typing import Dict, List, Optional
 
 from langchain_core.documents import Document
 
+try:
+    from sklearn.feature_extraction.text import TfidfVectorizer
+except ImportError:  # extra "faq" не установлен — используем полный перебор
+    TfidfVectorizer = None
+
 logger = logging.getLogger(__name__)
 
+# Сколько ближайших по TF-IDF вопросов проверять точным SequenceMatcher.
+# Это приближение: вопрос с лучшим ratio() может не попасть в короткий список,
+# если его косинусная близость n-грамм ниже, чем у пяти других. Поэтому с
+# установленным scikit-learn результат может отличаться от полного перебора.
+SHORTLIST_SIZE = 5
+
 _faq_documents: List[Document] = []
+# Документы с question_normalized в порядке строк _faq_matrix
+_faq_indexed: List[Document] = []
+# Точное совпадение нормализованного вопроса — самый частый случай
+_faq_by_question: Dict[str, Document] = {}
+_faq_vectorizer = None
+_faq_matrix = None
 
 
 def update_faq_documents(documents: List[Document]) -> None:
     """Обновить локальный кеш FAQ-документов для быстрого поиска."""
-    global _faq_documents
+    global _faq_documents, _faq_indexed, _faq_by_question, _faq_vectorizer, _faq_matrix
     _faq_documents = documents or []
+    _faq_indexed = [
+        doc for doc in _faq_documents if doc.metadata.get("question_normalized")
+    ]
+    _faq_by_question = {}
+    for doc in _faq_indexed:
+        _faq_by_question.setdefault(doc.metadata["question_normalized"], doc)
+    _faq_vectorizer = None
+    _faq_matrix = None
+    if TfidfVectorizer is not None and _faq_indexed:
+        # Строки матрицы нормированы (norm="l2"), поэтому скалярное произведение
+        # с вектором запроса сразу даёт косинусную близость
+        _faq_vectorizer = TfidfVectorizer(analyzer="char_wb", ngram_range=(3, 5))
+        _faq_matrix = _faq_vectorizer.fit_transform(
+            [doc.metadata["question_normalized"] for doc in _faq_indexed]
+        )
     logger.info("FAQ lookup cache updated: %d entries", len(_faq_documents))
 
 
@@ -20,27 +52,54 @@ def _normalize(text: str) -> str:
     return " ".join(text.strip().lower().split())
 
 
+def _candidates(normalized_query: str) -> List[Document]:
+    """Короткий список кандидатов по косинусной близости char-n-грамм."""
+    if _faq_matrix is None or len(_faq_indexed) <= SHORTLIST_SIZE:
+        return _faq_indexed
+    query_vector = _faq_vectorizer.transform([normalized_query])
+    scores = (_faq_matrix @ query_vector.T).toarray().ravel()
+    top = scores.argpartition(-SHORTLIST_SIZE)[-SHORTLIST_SIZE:]
+    return [_faq_indexed[i] for i in top]
+
+
+def find_exact_match(question: str) -> Optional[Document]:
+    """FAQ-документ, нормализованный вопрос которого совпадает с запросом."""
+    if not _faq_by_question or not question:
+        return None
+    return _faq_by_question.get(_normalize(question))
+
+
 def find_best_match(question: str, threshold: float = 0.82) -> Optional[Document]:
     """
     Находит наиболее похожий FAQ-документ по тексту вопроса.
     Возвращает None, если схожесть ниже порога.
     """
-    if not _faq_documents or not question:
+    if not _faq_indexed or not question:
         return None
-    
+
     normalized_query = _normalize(question)
+    exact = _faq_by_question.get(normalized_query)
+    if exact is not None:
+        logger.debug("FAQ override exact hit: '%s'", question)
+        return exact
+
     best_doc: Optional[Document] = None
     best_score = 0.0
-    
-    for doc in _faq_documents:
-        normalized_question = doc.metadata.get("question_normalized")
-        if not normalized_question:
+    # Как в difflib.get_close_matches: запрос во втором аргументе, чтобы его
+    # индекс строился один раз, а дешёвые верхние оценки отсекали кандидатов
+    matcher = SequenceMatcher()
+    matcher.set_seq2(normalized_query)
+
+    for doc in _candidates(normalized_query):
+        matcher.set_seq1(doc.metadata["question_normalized"])
+        floor = max(best_score, threshold)
+        if matcher.real_quick_ratio() < floor or matcher.quick_ratio() < floor:
             continue
-        score = SequenceMatcher(None, normalized_query, normalized_question).ratio()
+        score = matcher.ratio()
         if score > best_score:
             best_doc = doc
             best_score = score
-    
+
     if best_doc and best_score >= threshold:
         logger.debug(
             "FAQ override hit: '%s' -> '%s' (score=%.2f)",
@@ -49,5 +108,5 @@ def find_best_match(question: str, threshold: float = 0.82) -> Optional[Document
             best_score,
         )
         return best_doc
-    
+
     return None
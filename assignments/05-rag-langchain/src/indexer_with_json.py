@@ -1,13 +1,23 @@
+import asyncio
 import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import json
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import InMemoryVectorStore
 from langchain_core.documents import Document
 from config import config
+from embedding_cache import CachedEmbeddings
 import faq_lookup
+from vector_index import MatrixVectorStore
+
+try:
+    import orjson
+except ImportError:  # orjson не установлен — используем стандартный json
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
@@ -20,20 +30,23 @@ def load_json_documents(json_file_path: str) -> list:
     Загрузка документов из JSON файла с вопросами-ответами
     Каждая пара Q&A становится отдельным чанком
     """
-    from pathlib import Path
-    
     json_path = Path(json_file_path)
     if not json_path.exists():
         logger.warning(f"JSON file {json_file_path} does not exist")
         return []
     try:
-        raw_data = json.loads(json_path.read_text(encoding="utf-8"))
-    except json.JSONDecodeError as exc:
+        if orjson is not None:
+            # orjson разбирает UTF-8 байты напрямую, без промежуточной str
+            raw_data = orjson.loads(json_path.read_bytes())
+        else:
+            raw_data = json.loads(json_path.read_text(encoding="utf-8"))
+    except json.JSONDecodeError as exc:  # orjson.JSONDecodeError — его подкласс
         logger.error(f"Failed to parse JSON {json_file_path}: {exc}")
         return []
     
     documents: list[Document] = []
     seen_pairs = set()
+    source = str(json_path)
     
     for item in raw_data:
         question = (item.get("question") or "").strip()
@@ -47,12 +60,13 @@ def load_json_documents(json_file_path: str) -> list:
         seen_pairs.add(qa_key)
         
         metadata = {
-            "source": str(json_path),
+            "source": source,
             "category": item.get("category"),
             "url": item.get("url"),
             "type": item.get("type", "faq"),
             "question": question,
             "question_normalized": _normalize_question(question),
+            "answer": answer,
         }
         page_content = f"Вопрос: {question}\nОтвет: {answer}"
         documents.append(Document(page_content=page_content, metadata=metadata))
@@ -60,6 +74,10 @@ def load_json_documents(json_file_path: str) -> list:
     logger.info(f"Loaded {len(documents)} unique Q&A pairs from JSON")
     return documents
 
+def _load_one_pdf(path: str) -> list:
+    return PyPDFLoader(path).load()
+
+
 def load_pdf_documents(data_dir: str) -> list:
     """Загрузка всех PDF документов из директории"""
     pages = []
@@ -72,47 +90,85 @@ def load_pdf_documents(data_dir: str) -> list:
     pdf_files = list(data_path.glob("*.pdf"))
     logger.info(f"Found {len(pdf_files)} PDF files in {data_dir}")
     
-    for pdf_file in pdf_files:
-        loader = PyPDFLoader(str(pdf_file))
-        pages.extend(loader.load())
+    if len(pdf_files) > 1:
+        # Разбор PDF нагружает CPU — раскладываем файлы по процессам.
+        # Функция вызывается из потока (asyncio.to_thread), а fork
+        # многопоточного процесса может подвесить дочерний на чужой блокировке,
+        # поэтому процессы запускаем через spawn
+        workers = min(len(pdf_files), os.cpu_count() or 1)
+        with ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            loaded = list(executor.map(_load_one_pdf, map(str, pdf_files)))
+    else:
+        loaded = [_load_one_pdf(str(pdf_file)) for pdf_file in pdf_files]
+    
+    for pdf_file, pdf_pages in zip(pdf_files, loaded):
+        pages.extend(pdf_pages)
         logger.info(f"Loaded {pdf_file.name}")
     
     return pages
 
+# Сплиттер не хранит состояния между вызовами — собираем его один раз
+_TEXT_SPLITTER = RecursiveCharacterTextSplitter(
+    chunk_size=450,
+    chunk_overlap=120,
+    separators=[
+        "\n\n",       # основной разделитель параграфов
+        "\n•",        # маркеры списков
+        "\n- ",       # маркеры списков
+        "\n— ",       # списки с тире
+        "\n",         # одиночные переносы
+        ". ",         # конец предложения
+        " ",          # слова
+        ""            # fallback до символов
+    ],
+    keep_separator=True,
+    add_start_index=True
+)
+
 def split_documents(pages: list) -> list:
     """Разбиение документов с учетом структуры"""
     if not pages:
         return []
     
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=450,
-        chunk_overlap=120,
-        separators=[
-            "\n\n",       # основной разделитель параграфов
-            "\n•",        # маркеры списков
-            "\n- ",       # маркеры списков
-            "\n— ",       # списки с тире
-            "\n",         # одиночные переносы
-            ". ",         # конец предложения
-            " ",          # слова
-            ""            # fallback до символов
-        ],
-        keep_separator=True,
-        add_start_index=True
-    )
-    chunks = text_splitter.split_documents(pages)
+    chunks = _TEXT_SPLITTER.split_documents(pages)
     logger.info(f"Split into {len(chunks)} chunks (chunk_size=450, overlap=120)")
     return chunks
 
-def create_vector_store(chunks: list):
-    """Создание векторного хранилища"""
+async def create_vector_store(chunks: list):
+    """Создание векторного хранилища
+
+    Чанки эмбеддятся батчами по EMBEDDING_BATCH_SIZE, до EMBEDDING_CONCURRENCY
+    запросов к API одновременно. Уже посчитанные эмбеддинги неизменённых
+    чанков берутся из EMBEDDING_CACHE_PATH.
+    """
     embeddings = OpenAIEmbeddings(
-        model=config.EMBEDDING_MODEL
-    )
-    vector_store = InMemoryVectorStore.from_documents(
-        documents=chunks,
-        embedding=embeddings
+        model=config.EMBEDDING_MODEL,
+        chunk_size=config.EMBEDDING_BATCH_SIZE
     )
+    if config.EMBEDDING_CACHE_PATH:
+        embeddings = CachedEmbeddings(
+            embeddings, config.EMBEDDING_MODEL, config.EMBEDDING_CACHE_PATH
+        )
+    vector_store = MatrixVectorStore(embedding=embeddings)
+    semaphore = asyncio.Semaphore(config.EMBEDDING_CONCURRENCY)
+    batch_size = config.EMBEDDING_BATCH_SIZE
+
+    async def add_batch(batch: list) -> None:
+        async with semaphore:
+            await vector_store.aadd_documents(batch)
+
+    try:
+        await asyncio.gather(*(
+            add_batch(chunks[i:i + batch_size])
+            for i in range(0, len(chunks), batch_size)
+        ))
+    finally:
+        # Кеш нужен только на время индексации, иначе каждая переиндексация
+        # оставляет открытое соединение с SQLite
+        if isinstance(embeddings, CachedEmbeddings):
+            embeddings.close()
     logger.info(f"Created vector store with {len(chunks)} chunks")
     return vector_store
 
@@ -122,7 +178,7 @@ async def reindex_all():
     
     try:
         # 1. Загружаем и обрабатываем PDF документы
-        pdf_pages = load_pdf_documents(config.DATA_DIR)
+        pdf_pages = await asyncio.to_thread(load_pdf_documents, config.DATA_DIR)
         if not pdf_pages:
             logger.warning("No PDF documents found to index")
         
@@ -148,7 +204,7 @@ async def reindex_all():
         logger.info(f"Total chunks to index: {len(all_chunks)} (PDF: {len(pdf_chunks)}, JSON: {len(json_chunks)})")
             
         # 4. Создаём векторное хранилище
-        vector_store = create_vector_store(all_chunks)
+        vector_store = await create_vector_store(all_chunks)
         logger.info("Reindexing completed successfully")
         return vector_store
         
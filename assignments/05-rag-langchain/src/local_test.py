@@ -78,8 +78,7 @@ async def main():
     if vector_store is None:
         raise SystemExit("Не удалось построить векторное хранилище. Проверьте данные.")
 
-    doc_count = len(vector_store.store) if hasattr(vector_store, "store") else "unknown"
-    print(f"Всего документов после индексации: {doc_count}")
+    print(f"Всего документов после индексации: {rag.get_vector_count(vector_store)}")
 
     for question in questions:
         docs = vector_store.similarity_search(question, k=args.top_k)
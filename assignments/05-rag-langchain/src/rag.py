@@ -5,6 +5,7 @@ from langchain_core.runnables import RunnablePassthrough
 from langchain_openai import ChatOpenAI
 from config import config
 import faq_lookup
+from semantic_cache import SemanticAnswerCache
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +19,13 @@ _retrieval_query_transform_prompt = None
 _llm_query_transform = None
 _llm = None
 
+# Ответы на первые вопросы диалога по близости эмбеддингов вопроса
+_answer_cache = SemanticAnswerCache(
+    threshold=config.SEMANTIC_CACHE_THRESHOLD,
+    ttl=config.SEMANTIC_CACHE_TTL,
+    max_size=config.SEMANTIC_CACHE_SIZE,
+)
+
 def initialize_retriever():
     """Инициализация retriever из векторного хранилища"""
     global retriever
@@ -26,6 +34,8 @@ def initialize_retriever():
         return False
     
     retriever = vector_store.as_retriever(search_kwargs={'k': config.RETRIEVER_K})
+    # Ответы из старого индекса могут не соответствовать новым документам
+    _answer_cache.clear()
     logger.info(f"Retriever initialized with k={config.RETRIEVER_K}")
     return True
 
@@ -154,21 +164,44 @@ async def rag_answer(messages):
         raise ValueError("Векторное хранилище не инициализировано. Запустите индексацию.")
     
     last_user_message = messages[-1].content if messages else ""
+    
+    # Дословный вопрос из FAQ: отвечаем сохранённым ответом без эмбеддинга и LLM
+    exact_document = faq_lookup.find_exact_match(last_user_message)
+    if exact_document is not None and exact_document.metadata.get("answer"):
+        logger.info("FAQ exact answer returned without LLM call")
+        return exact_document.metadata["answer"]
+    
+    # Без истории ответ зависит только от вопроса — его можно взять из кеша
+    query_vector = None
+    if len(messages) == 1 and config.SEMANTIC_CACHE_SIZE > 0:
+        query_vector = await vector_store.embeddings.aembed_query(last_user_message)
+        cached = _answer_cache.get(query_vector)
+        if cached is not None:
+            return cached
+    
     faq_document = faq_lookup.find_best_match(last_user_message)
     if faq_document:
         context = format_chunks([faq_document])
         answer_chain = _get_answer_chain()
         result = await answer_chain.ainvoke({"messages": messages, "context": context})
-        return result
+    else:
+        rag_chain = get_rag_chain()
+        result = await rag_chain.ainvoke({"messages": messages})
     
-    rag_chain = get_rag_chain()
-    result = await rag_chain.ainvoke({"messages": messages})
+    if query_vector is not None:
+        _answer_cache.put(query_vector, result)
     return result
 
+def get_vector_count(store) -> int:
+    """Число векторов в хранилище: FAISS-подобные отдают index.ntotal, InMemory — размер store"""
+    index = getattr(store, "index", None)
+    if index is not None and hasattr(index, "ntotal"):
+        return index.ntotal
+    return len(getattr(store, "store", ()))
+
 def get_vector_store_stats():
     """Возвращает статистику векторного хранилища"""
     if vector_store is None:
         return {"status": "not initialized", "count": 0}
     
-    doc_count = len(vector_store.store) if hasattr(vector_store, 'store') else 0
-    return {"status": "initialized", "count": doc_count}
+    return {"status": "initialized", "count": get_vector_count(vector_store)}
@@ -0,0 +1,71 @@
+import logging
+import time
+from typing import List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticAnswerCache:
+    """
+    Кеш ответов по близости эмбеддингов вопросов.
+    Если новый вопрос почти совпадает по косинусу с уже отвеченным
+    (не старше ttl секунд), возвращается сохранённый ответ без вызова цепочки.
+    """
+
+    def __init__(self, threshold: float, ttl: float, max_size: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self) -> None:
+        # Кольцевой буфер на max_size записей: матрица выделяется один раз при
+        # первой вставке (размерность заранее неизвестна), новая запись
+        # перезаписывает самую старую по индексу _next
+        size = max(self.max_size, 0)
+        self._vectors: Optional[np.ndarray] = None
+        self._answers: List[Optional[str]] = [None] * size
+        self._created = np.full(size, -np.inf)
+        self._next = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self._live()))
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> np.ndarray:
+        array = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(array)
+        return array / norm if norm else array
+
+    def _live(self) -> np.ndarray:
+        """Маска записей, которые не старше ttl секунд."""
+        return self._created[:self._count] >= time.monotonic() - self.ttl
+
+    def get(self, vector: List[float]) -> Optional[str]:
+        if not self._count:
+            return None
+        live = self._live()
+        if not live.any():
+            return None
+        similarity = self._vectors[:self._count] @ self._normalize(vector)
+        similarity[~live] = -np.inf
+        best = int(similarity.argmax())
+        if similarity[best] < self.threshold:
+            return None
+        logger.debug(f"Semantic cache hit (score={similarity[best]:.3f})")
+        return self._answers[best]
+
+    def put(self, vector: List[float], answer: str) -> None:
+        if self.max_size <= 0:
+            return
+        row = self._normalize(vector)
+        if self._vectors is None:
+            self._vectors = np.empty((self.max_size, row.shape[0]), dtype=np.float32)
+        self._vectors[self._next] = row
+        self._answers[self._next] = answer
+        self._created[self._next] = time.monotonic()
+        self._next = (self._next + 1) % self.max_size
+        self._count = min(self._count + 1, self.max_size)
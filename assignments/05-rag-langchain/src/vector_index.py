@@ -0,0 +1,72 @@
+from typing import Any
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import InMemoryVectorStore
+
+
+class MatrixVectorStore(InMemoryVectorStore):
+    """
+    InMemoryVectorStore с поиском по непрерывной float32-матрице.
+    Базовый класс на каждый запрос заново собирает numpy-массив из списков
+    всех векторов; здесь нормированная матрица строится один раз после
+    изменения хранилища, а поиск сводится к одному матричному умножению.
+    """
+
+    def __init__(self, embedding: Any, **kwargs: Any) -> None:
+        super().__init__(embedding, **kwargs)
+        self._docs: list = []
+        self._matrix = None
+
+    def _invalidate(self) -> None:
+        self._docs = []
+        self._matrix = None
+
+    def add_documents(self, documents, ids=None, **kwargs):
+        ids_ = super().add_documents(documents, ids=ids, **kwargs)
+        self._invalidate()
+        return ids_
+
+    async def aadd_documents(self, documents, ids=None, **kwargs):
+        ids_ = await super().aadd_documents(documents, ids=ids, **kwargs)
+        self._invalidate()
+        return ids_
+
+    def delete(self, ids=None, **kwargs):
+        super().delete(ids, **kwargs)
+        self._invalidate()
+
+    async def adelete(self, ids=None, **kwargs):
+        await super().adelete(ids, **kwargs)
+        self._invalidate()
+
+    def _ensure_matrix(self) -> np.ndarray:
+        if self._matrix is None:
+            self._docs = list(self.store.values())
+            matrix = np.asarray([doc["vector"] for doc in self._docs], dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            self._matrix = matrix / norms
+        return self._matrix
+
+    def _similarity_search_with_score_by_vector(self, embedding, k=4, filter=None):  # noqa: A002
+        if filter is not None or not self.store:
+            return super()._similarity_search_with_score_by_vector(embedding, k, filter)
+
+        matrix = self._ensure_matrix()
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        similarity = matrix @ (query / norm if norm else query)
+
+        k = min(k, len(self._docs))
+        top = np.argpartition(-similarity, k - 1)[:k]
+        top = top[np.argsort(-similarity[top])]
+        results = []
+        for idx in top:
+            doc = self._docs[idx]
+            results.append((
+                Document(id=doc["id"], page_content=doc["text"], metadata=doc["metadata"]),
+                float(similarity[idx]),
+                doc["vector"],
+            ))
+        return results
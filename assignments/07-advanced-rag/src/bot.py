@@ -65,6 +65,12 @@ async def main():
     else:
         logger.warning("⚠️  Indexing completed with no documents - bot will run but cannot answer questions")
     
+    # Cross-encoder грузится в фоне, пока бот начинает polling
+    # (ссылка на задачу держится до конца main, чтобы её не собрал GC)
+    warm_up_task = None
+    if config.RETRIEVAL_MODE == "hybrid_reranker":
+        warm_up_task = asyncio.create_task(asyncio.to_thread(rag.warm_up_cross_encoder))
+    
     bot = Bot(token=config.TELEGRAM_TOKEN)
     dp = Dispatcher()
     dp.include_router(router)
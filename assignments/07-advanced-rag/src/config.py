@@ -11,6 +11,7 @@ class Config:
     MODEL = os.getenv("MODEL")
     MODEL_QUERY_TRANSFORM = os.getenv("MODEL_QUERY_TRANSFORM", "gpt-4o")
     EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-large")
+    EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "256"))
     LLM_TEMPERATURE = float(os.getenv("LLM_TEMPERATURE", "0.2"))
     QUERY_TRANSFORM_TEMPERATURE = float(os.getenv("QUERY_TRANSFORM_TEMPERATURE", "0.2"))
     DATA_DIR = os.getenv("DATA_DIR", "data")
@@ -34,6 +35,8 @@ class Config:
     # Cross-Encoder Reranking Configuration
     CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
     RERANKER_TOP_K = int(os.getenv("RERANKER_TOP_K", "3"))
+    CROSS_ENCODER_BACKEND = os.getenv("CROSS_ENCODER_BACKEND", "torch")  # torch/onnx/openvino
+    CROSS_ENCODER_DEVICE = os.getenv("CROSS_ENCODER_DEVICE") or None  # cpu/cuda/mps, пусто — автовыбор
     
     # Отображение источников
     SHOW_SOURCES = os.getenv("SHOW_SOURCES", "false").lower() == "true"
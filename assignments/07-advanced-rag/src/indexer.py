@@ -1,42 +1,40 @@
 import logging
+from itertools import islice
 from pathlib import Path
+from typing import Iterable, Iterator
 from langchain_community.document_loaders import PyPDFLoader, JSONLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_community.vectorstores import InMemoryVectorStore
+from langchain_core.documents import Document
 from config import config
 
 logger = logging.getLogger(__name__)
 
-def load_pdf_documents(data_dir: str) -> list:
-    """Загрузка всех PDF документов из директории"""
-    pages = []
+def load_pdf_documents(data_dir: str) -> Iterator[Document]:
+    """Постраничная загрузка всех PDF документов из директории (генератор)"""
     data_path = Path(data_dir)
     
     if not data_path.exists():
         logger.warning(f"Directory {data_dir} does not exist")
-        return pages
+        return
     
     pdf_files = list(data_path.glob("*.pdf"))
     logger.info(f"Found {len(pdf_files)} PDF files in {data_dir}")
     
     for pdf_file in pdf_files:
-        loader = PyPDFLoader(str(pdf_file))
-        pages.extend(loader.load())
+        yield from PyPDFLoader(str(pdf_file)).lazy_load()
         logger.info(f"Loaded {pdf_file.name}")
-    
-    return pages
 
-def split_documents(pages: list) -> list:
-    """Разбиение документов на чанки"""
+def split_documents(pages: Iterable[Document]) -> Iterator[Document]:
+    """Разбиение документов на чанки по мере чтения страниц"""
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=500,
         chunk_overlap=50
     )
-    chunks = text_splitter.split_documents(pages)
-    logger.info(f"Split into {len(chunks)} chunks")
-    return chunks
+    for page in pages:
+        yield from text_splitter.split_documents([page])
 
 def load_json_documents(json_file_path: str) -> list:
     """Загрузка Q&A пар из JSON, каждая пара - отдельный чанк"""
@@ -80,14 +78,16 @@ def create_embeddings():
     else:
         raise ValueError(f"Unknown embedding provider: {provider}. Use 'openai' or 'huggingface'")
 
-def create_vector_store(chunks: list):
-    """Создание векторного хранилища"""
+def create_vector_store(chunks: Iterable[Document]):
+    """Создание векторного хранилища, чанки эмбеддятся батчами по EMBEDDING_BATCH_SIZE"""
     embeddings = create_embeddings()
-    vector_store = InMemoryVectorStore.from_documents(
-        documents=chunks,
-        embedding=embeddings
-    )
-    logger.info(f"Created vector store with {len(chunks)} chunks")
+    vector_store = InMemoryVectorStore(embedding=embeddings)
+    chunks_iter = iter(chunks)
+    total = 0
+    while batch := list(islice(chunks_iter, config.EMBEDDING_BATCH_SIZE)):
+        vector_store.add_documents(batch)
+        total += len(batch)
+    logger.info(f"Created vector store with {total} chunks")
     return vector_store
 
 async def reindex_all():
@@ -100,8 +100,8 @@ async def reindex_all():
     
     try:
         # Загрузка PDF документов
-        pages = load_pdf_documents(config.DATA_DIR)
-        pdf_chunks = split_documents(pages) if pages else []
+        # Страницы не накапливаются: каждая сразу режется на чанки
+        pdf_chunks = list(split_documents(load_pdf_documents(config.DATA_DIR)))
         logger.info(f"PDF: {len(pdf_chunks)} chunks")
         
         # Загрузка JSON Q&A пар
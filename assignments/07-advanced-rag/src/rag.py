@@ -1,10 +1,17 @@
+import asyncio
+import hashlib
 import logging
+import os
+import threading
+from collections import OrderedDict, defaultdict
+from functools import lru_cache
 from typing import List
+import numpy as np
 from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda
 from langchain_openai import ChatOpenAI
 from langchain_community.retrievers import BM25Retriever
 from langchain_classic.retrievers import EnsembleRetriever
@@ -17,6 +24,9 @@ vector_store = None
 retriever = None
 chunks = None  # Для BM25 retriever
 cross_encoder = None  # Для reranking (lazy loading)
+_cross_encoder_lock = threading.Lock()
+# Последний построенный BM25 и хеш чанков, из которых он построен
+_bm25_cache = {"signature": None, "retriever": None}
 
 # Кеши для промптов и LLM клиентов
 _conversational_answering_prompt = None
@@ -24,6 +34,14 @@ _retrieval_query_transform_prompt = None
 _llm_query_transform = None
 _llm = None
 
+# Собранные LCEL-цепочки: сбрасываются при пересоздании retriever
+_query_transformation_chain = None
+_rag_chain_cache = {}
+
+# LRU эмбеддингов запросов: повторные вопросы не эмбеддятся заново
+QUERY_EMBEDDING_CACHE_SIZE = 256
+_query_embedding_cache: "OrderedDict[str, List[float]]" = OrderedDict()
+
 def get_last_user_query(messages) -> str:
     """Возвращает текст последнего пользовательского сообщения"""
     if not messages:
@@ -37,15 +55,15 @@ def get_last_user_query(messages) -> str:
 def deduplicate_documents(documents: List[Document]) -> List[Document]:
     """Удаляет дубликаты документов, сохраняя порядок появления"""
     unique_docs = []
-    seen_keys = set()
+    seen_keys: set[bytes] = set()
     for doc in documents or []:
         page_content = getattr(doc, "page_content", "") or ""
         metadata = getattr(doc, "metadata", {}) or {}
-        key = (
-            metadata.get("source", ""),
-            metadata.get("page", ""),
-            page_content.strip()
-        )
+        # В множестве храним 16-байтовый дайджест, а не копию текста чанка
+        key = hashlib.blake2b(
+            f"{metadata.get('source', '')}\x00{metadata.get('page', '')}\x00{page_content.strip()}".encode("utf-8"),
+            digest_size=16
+        ).digest()
         if key in seen_keys:
             continue
         seen_keys.add(key)
@@ -66,13 +84,65 @@ def retrieve_documents_for_query(query: str) -> List[Document]:
         logger.error(f"Retrieval failed for query '{query[:50]}': {e}")
         return []
 
-def collect_retrieval_documents(original_query: str, transformed_query: str) -> List[Document]:
-    """Комбинирует результаты original + transformed запросов с дедупликацией"""
-    documents = []
-    documents.extend(retrieve_documents_for_query(original_query))
+async def aretrieve_documents_for_query(query: str) -> List[Document]:
+    """Асинхронный вариант retrieve_documents_for_query"""
+    if retriever is None or not query:
+        return []
+    try:
+        documents = await retriever.ainvoke(query)
+        return documents or []
+    except Exception as e:
+        logger.error(f"Retrieval failed for query '{query[:50]}': {e}")
+        return []
+
+def _retrieval_queries(original_query: str, transformed_query: str) -> List[str]:
+    queries = [original_query] if original_query else []
     if transformed_query and transformed_query != original_query:
-        documents.extend(retrieve_documents_for_query(transformed_query))
-    combined = deduplicate_documents(documents)
+        queries.append(transformed_query)
+    return queries
+
+def _use_vector_search() -> bool:
+    # В semantic режиме ищем по эмбеддингам напрямую: запросы эмбеддятся
+    # одним вызовом API, а повторные берутся из LRU
+    return config.RETRIEVAL_MODE.lower() == "semantic"
+
+def _cached_query_vectors(queries: List[str]):
+    """Возвращает найденные в LRU векторы (None для промахов) и список промахов"""
+    vectors = []
+    for query in queries:
+        vector = _query_embedding_cache.get(query)
+        if vector is not None:
+            _query_embedding_cache.move_to_end(query)
+        vectors.append(vector)
+    missing = [query for query, vector in zip(queries, vectors) if vector is None]
+    return vectors, missing
+
+def _remember_query_vectors(queries: List[str], vectors, missing: List[str], new_vectors) -> list:
+    fresh = dict(zip(missing, new_vectors))
+    for query, vector in fresh.items():
+        _query_embedding_cache[query] = vector
+        if len(_query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            _query_embedding_cache.popitem(last=False)
+    return [vector if vector is not None else fresh[query] for query, vector in zip(queries, vectors)]
+
+def _embed_queries(queries: List[str]) -> list:
+    vectors, missing = _cached_query_vectors(queries)
+    new_vectors = vector_store.embeddings.embed_documents(missing) if missing else []
+    return _remember_query_vectors(queries, vectors, missing, new_vectors)
+
+async def _aembed_queries(queries: List[str]) -> list:
+    vectors, missing = _cached_query_vectors(queries)
+    new_vectors = await vector_store.embeddings.aembed_documents(missing) if missing else []
+    return _remember_query_vectors(queries, vectors, missing, new_vectors)
+
+def _search_by_vectors(vectors) -> List[List[Document]]:
+    return [
+        vector_store.similarity_search_by_vector(vector, k=config.SEMANTIC_RETRIEVER_K)
+        for vector in vectors
+    ]
+
+def _combine_retrieved(results: List[List[Document]], original_query: str, transformed_query: str) -> List[Document]:
+    combined = deduplicate_documents([doc for documents in results for doc in documents])
     logger.debug(
         "Combined %d unique documents from queries (original=%s, transformed=%s)",
         len(combined),
@@ -81,6 +151,32 @@ def collect_retrieval_documents(original_query: str, transformed_query: str) ->
     )
     return combined
 
+def collect_retrieval_documents(original_query: str, transformed_query: str) -> List[Document]:
+    """Комбинирует результаты original + transformed запросов с дедупликацией"""
+    queries = _retrieval_queries(original_query, transformed_query)
+    if queries and _use_vector_search():
+        try:
+            results = _search_by_vectors(_embed_queries(queries))
+        except Exception as e:
+            logger.error(f"Vector retrieval failed: {e}")
+            results = []
+    else:
+        results = [retrieve_documents_for_query(query) for query in queries]
+    return _combine_retrieved(results, original_query, transformed_query)
+
+async def acollect_retrieval_documents(original_query: str, transformed_query: str) -> List[Document]:
+    """Асинхронный вариант: запросы к retriever выполняются параллельно"""
+    queries = _retrieval_queries(original_query, transformed_query)
+    if queries and _use_vector_search():
+        try:
+            results = _search_by_vectors(await _aembed_queries(queries))
+        except Exception as e:
+            logger.error(f"Vector retrieval failed: {e}")
+            results = []
+    else:
+        results = await asyncio.gather(*(aretrieve_documents_for_query(query) for query in queries))
+    return _combine_retrieved(results, original_query, transformed_query)
+
 def rerank_with_cross_encoder(query: str, documents: List[Document], top_k: int = None) -> List[Document]:
     """Переранжирует документы и возвращает top_k Document"""
     if not documents:
@@ -94,6 +190,10 @@ def rerank_with_cross_encoder(query: str, documents: List[Document], top_k: int
         return documents[:top_k] if top_k else documents
     return [doc for doc, _ in reranked]
 
+async def arerank_with_cross_encoder(query: str, documents: List[Document], top_k: int = None) -> List[Document]:
+    """rerank_with_cross_encoder в рабочем потоке: predict не блокирует event loop"""
+    return await asyncio.to_thread(rerank_with_cross_encoder, query, documents, top_k)
+
 def create_semantic_retriever():
     """Создание semantic retriever из vector store"""
     if vector_store is None:
@@ -102,12 +202,26 @@ def create_semantic_retriever():
         search_kwargs={'k': config.SEMANTIC_RETRIEVER_K}
     )
 
+def _chunks_signature(documents) -> bytes:
+    """Хеш содержимого чанков: совпадает, пока корпус не изменился"""
+    digest = hashlib.blake2b(digest_size=16)
+    for doc in documents:
+        digest.update(doc.page_content.encode("utf-8"))
+        digest.update(b"\x00")
+    return digest.digest()
+
 def create_bm25_retriever():
-    """Создание BM25 retriever из chunks"""
+    """Создание BM25 retriever из chunks (переиспользуется для того же корпуса)"""
     if chunks is None or len(chunks) == 0:
         raise ValueError("Chunks not initialized for BM25")
+    signature = _chunks_signature(chunks)
+    if _bm25_cache["signature"] == signature:
+        logger.info("Reusing BM25 index for unchanged chunks")
+        return _bm25_cache["retriever"]
     bm25 = BM25Retriever.from_documents(chunks)
     bm25.k = config.BM25_RETRIEVER_K
+    _bm25_cache["signature"] = signature
+    _bm25_cache["retriever"] = bm25
     return bm25
 
 def create_hybrid_retriever():
@@ -126,17 +240,44 @@ def create_hybrid_retriever():
 def get_cross_encoder():
     """Ленивая инициализация cross-encoder для reranking"""
     global cross_encoder
-    if cross_encoder is None:
+    if cross_encoder is not None:
+        return cross_encoder
+    # Прогрев при старте и первый запрос не должны загрузить модель дважды
+    with _cross_encoder_lock:
+        if cross_encoder is not None:
+            return cross_encoder
         try:
             from sentence_transformers import CrossEncoder
-            logger.info(f"Loading cross-encoder model: {config.CROSS_ENCODER_MODEL}")
-            cross_encoder = CrossEncoder(config.CROSS_ENCODER_MODEL)
+            backend = config.CROSS_ENCODER_BACKEND.lower()
+            device = config.CROSS_ENCODER_DEVICE
+            logger.info(f"Loading cross-encoder model: {config.CROSS_ENCODER_MODEL} ({backend}, device={device or 'auto'})")
+            encoder = None
+            if backend != "torch":
+                # ONNX/OpenVINO требуют extras sentence-transformers[onnx]/[openvino]
+                try:
+                    encoder = CrossEncoder(config.CROSS_ENCODER_MODEL, device=device, backend=backend)
+                except Exception as e:
+                    logger.warning(f"Cross-encoder backend '{backend}' unavailable, using torch: {e}")
+            if encoder is None:
+                encoder = CrossEncoder(config.CROSS_ENCODER_MODEL, device=device)
+                if str(encoder.device).startswith("cuda"):
+                    # fp16 на GPU: вдвое меньше памяти и быстрее на тензорных ядрах
+                    encoder.model.half()
+            cross_encoder = encoder
             logger.info("✓ Cross-encoder loaded successfully")
         except Exception as e:
             logger.error(f"Failed to load cross-encoder: {e}", exc_info=True)
             raise
     return cross_encoder
 
+def warm_up_cross_encoder():
+    """Загружает cross-encoder заранее, чтобы первый запрос не ждал загрузки модели"""
+    try:
+        get_cross_encoder()
+    except Exception:
+        # Ошибка уже залогирована; повторная попытка будет при первом reranking
+        pass
+
 def rerank_documents(query: str, documents: list, top_k: int = None):
     """
     Переранжирование документов с помощью cross-encoder
@@ -160,16 +301,27 @@ def rerank_documents(query: str, documents: list, top_k: int = None):
     # Создаем пары (query, document_text) для cross-encoder
     pairs = [(query, doc.page_content) for doc in documents]
     
-    # Cross-encoder оценивает релевантность каждой пары
-    scores = encoder.predict(pairs)
+    # Cross-encoder оценивает все пары одним батчем (паддинг до самой длинной пары)
+    scores = encoder.predict(
+        pairs,
+        batch_size=len(pairs),
+        show_progress_bar=False,
+        convert_to_numpy=True
+    )
+    
+    scores = np.asarray(scores, dtype=np.float32)
     
-    # Сортируем по убыванию score
-    ranked = sorted(zip(documents, scores), key=lambda x: x[1], reverse=True)
+    # Отбираем top_k без полной сортировки, затем упорядочиваем только их по убыванию score
+    if len(scores) > top_k:
+        top_idx = np.argpartition(-scores, top_k)[:top_k]
+    else:
+        top_idx = np.arange(len(scores))
+    top_idx = top_idx[np.argsort(-scores[top_idx], kind="stable")]
     
     logger.info(f"Reranked {len(documents)} documents, returning top {top_k}")
     
     # Возвращаем top_k наиболее релевантных
-    return ranked[:top_k]
+    return [(documents[i], float(scores[i])) for i in top_idx]
 
 def create_retriever():
     """Фабрика для создания retriever по режиму"""
@@ -201,12 +353,20 @@ def initialize_retriever():
     
     try:
         retriever = create_retriever()
+        _rag_chain_cache.clear()
+        # Новый индекс может быть построен другой моделью эмбеддингов
+        _query_embedding_cache.clear()
         logger.info(f"✓ Retriever initialized in '{config.RETRIEVAL_MODE}' mode")
         return True
     except Exception as e:
         logger.error(f"Failed to initialize retriever: {e}", exc_info=True)
         return False
 
+@lru_cache(maxsize=256)
+def _basename(source: str) -> str:
+    """Имя файла из пути источника (источников немного, результат кешируется)"""
+    return os.path.basename(source)
+
 def format_chunks(chunks):
     """
     Форматирование чанков с метаданными для лучшей прозрачности
@@ -221,7 +381,7 @@ def format_chunks(chunks):
         page = chunk.metadata.get('page', 'N/A')
         
         # Извлекаем имя файла из пути
-        source_name = source.split('/')[-1] if '/' in source else source
+        source_name = _basename(source)
         
         # Форматируем чанк
         formatted_parts.append(
@@ -239,16 +399,14 @@ def format_sources(documents):
         return None
     
     # Группируем страницы по файлам
-    sources_by_file = {}
+    sources_by_file = defaultdict(list)
     for doc in documents:
-        source = doc.metadata.get('source', 'Unknown')
-        source_name = source.split('/')[-1] if '/' in source else source
+        source_name = _basename(doc.metadata.get('source', 'Unknown'))
         page = doc.metadata.get('page', 'N/A')
         
-        if source_name not in sources_by_file:
-            sources_by_file[source_name] = []
+        pages = sources_by_file[source_name]
         if page != 'N/A':
-            sources_by_file[source_name].append(str(page))
+            pages.append(str(page))
     
     # Форматируем компактно
     parts = []
@@ -319,54 +477,74 @@ def _get_llm():
     return _llm
 
 def get_retrieval_query_transformation_chain():
-    """Цепочка трансформации запроса"""
-    _, retrieval_query_transform_prompt = _load_prompts()
-    return (
-        retrieval_query_transform_prompt
-        | _get_llm_query_transform()
-        | StrOutputParser()
-    )
+    """Цепочка трансформации запроса (собирается один раз)"""
+    global _query_transformation_chain
+    if _query_transformation_chain is None:
+        _, retrieval_query_transform_prompt = _load_prompts()
+        _query_transformation_chain = (
+            retrieval_query_transform_prompt
+            | _get_llm_query_transform()
+            | StrOutputParser()
+        )
+    return _query_transformation_chain
 
 def get_rag_chain():
-    """Финальная RAG-цепочка возвращающая answer и documents в LCEL стиле"""
+    """Финальная RAG-цепочка возвращающая answer и documents в LCEL стиле
+
+    Шаги выполняются одной функцией внутри RunnableLambda (sync и async
+    варианты) вместо цепочки RunnablePassthrough.assign с промежуточными dict.
+    """
     if retriever is None:
         raise ValueError("Retriever not initialized")
     
-    conversational_answering_prompt, _ = _load_prompts()
     mode = config.RETRIEVAL_MODE.lower()
+    cache_key = (mode, id(retriever))
+    cached_chain = _rag_chain_cache.get(cache_key)
+    if cached_chain is not None:
+        return cached_chain
     
-    retrieval_chain = (
-        RunnablePassthrough.assign(
-            original_query=lambda x: get_last_user_query(x.get("messages", [])),
-            transformed_query=get_retrieval_query_transformation_chain()
-        )
-        | RunnablePassthrough.assign(
-            documents=lambda x: collect_retrieval_documents(
-                x.get("original_query", ""),
-                x.get("transformed_query", "")
+    conversational_answering_prompt, _ = _load_prompts()
+    answer_chain = conversational_answering_prompt | _get_llm() | StrOutputParser()
+    transformation_chain = get_retrieval_query_transformation_chain()
+    use_reranker = mode == "hybrid_reranker"
+    
+    def run(inputs: dict) -> dict:
+        messages = inputs.get("messages", [])
+        original_query = get_last_user_query(messages)
+        transformed_query = transformation_chain.invoke(inputs)
+        documents = collect_retrieval_documents(original_query, transformed_query)
+        if use_reranker:
+            documents = rerank_with_cross_encoder(
+                query=original_query or transformed_query or "",
+                documents=documents,
+                top_k=config.RERANKER_TOP_K
             )
-        )
-    )
-    
-    if mode == "hybrid_reranker":
-        retrieval_chain = retrieval_chain | RunnablePassthrough.assign(
-            documents=lambda x: rerank_with_cross_encoder(
-                query=x.get("original_query") or x.get("transformed_query") or "",
-                documents=x["documents"],
+        answer = answer_chain.invoke({
+            "context": format_chunks(documents),
+            "messages": messages
+        })
+        return {"answer": answer, "documents": documents}
+    
+    async def arun(inputs: dict) -> dict:
+        messages = inputs.get("messages", [])
+        original_query = get_last_user_query(messages)
+        transformed_query = await transformation_chain.ainvoke(inputs)
+        documents = await acollect_retrieval_documents(original_query, transformed_query)
+        if use_reranker:
+            documents = await arerank_with_cross_encoder(
+                query=original_query or transformed_query or "",
+                documents=documents,
                 top_k=config.RERANKER_TOP_K
             )
-        )
-    
-    return (
-        retrieval_chain
-        | RunnablePassthrough.assign(
-            answer=lambda x: (conversational_answering_prompt | _get_llm() | StrOutputParser()).invoke({
-                "context": format_chunks(x["documents"]),
-                "messages": x["messages"]
-            })
-        )
-        | (lambda x: {"answer": x["answer"], "documents": x["documents"]})
-    )
+        answer = await answer_chain.ainvoke({
+            "context": format_chunks(documents),
+            "messages": messages
+        })
+        return {"answer": answer, "documents": documents}
+    
+    rag_chain = RunnableLambda(run, afunc=arun, name="rag_chain")
+    _rag_chain_cache[cache_key] = rag_chain
+    return rag_chain
 
 async def rag_answer(messages):
     """
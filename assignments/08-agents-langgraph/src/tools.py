@@ -8,7 +8,14 @@ import json
 import logging
 import os
 import re
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 from langchain_core.tools import tool
+try:
+    import orjson
+except ImportError:  # orjson не установлен — используем стандартный json
+    orjson = None
 try:
     from tavily import TavilyClient
 except Exception:
@@ -17,6 +24,68 @@ import rag
 
 logger = logging.getLogger(__name__)
 
+
+def _dumps(payload: dict) -> str:
+    """Сериализует ответ инструмента в JSON с кириллицей как есть."""
+    if orjson is not None:
+        # orjson сразу пишет UTF-8 и заметно быстрее на больших page_content
+        return orjson.dumps(payload, default=str).decode("utf-8")
+    return json.dumps(payload, ensure_ascii=False)
+
+
+# Курс валюты к рублю: покупка и продажа банком
+Rate = namedtuple("Rate", ("buy", "sell"))
+
+# Регулярные выражения для разбора курсов компилируются один раз при импорте
+_CURRENCY_ALIASES = {
+    "USD": [r"USD", r"Доллара?(?:\s?США)?"],
+    "EUR": [r"EUR", r"Евро"],
+}
+# Один проход по тексту: именованная группа совпадает с кодом валюты, меткой или числом
+_TOKEN_RE = re.compile(
+    "|".join(
+        [rf"(?P<{code}>{'|'.join(aliases)})" for code, aliases in _CURRENCY_ALIASES.items()]
+        + [r"(?P<label>покупка|продажа|buy|sell|купить|продать)", r"(?P<num>\d+[.,]\d+)"]
+    ),
+    re.IGNORECASE,
+)
+_BUY_LABELS = frozenset(("покупка", "buy", "продать"))  # банк покупает валюту, пользователь продает
+_SELL_LABELS = frozenset(("продажа", "sell", "купить"))  # банк продает валюту, пользователь покупает
+_SUPPORTED_CURRENCIES = frozenset(("USD", "EUR", "RUB"))
+_COMMA_TO_DOT = str.maketrans(",", ".")
+# Дешевая проверка подстрокой перед запуском регулярного выражения
+_CURRENCY_TOKENS = ("usd", "eur", "доллар", "евро")
+# Сколько символов после упоминания валюты относятся к ней
+_CURRENCY_WINDOW = 320
+# Максимальное расстояние между меткой и числом (без учета пробельных символов)
+_LABEL_GAP = 12
+
+# Курсы СБОЛ меняются редко: повторные вызовы инструментов в пределах
+# _RATES_TTL секунд используют уже полученный результат без запросов к Tavily
+_RATES_TTL = 120.0
+_RATES_CACHE: tuple[float, dict[str, Rate]] | None = None
+
+# Пул для параллельных запросов к Tavily при получении курсов
+_TAVILY_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="tavily")
+
+# Сколько ждём основной запрос (по домену Сбербанка), прежде чем запускать
+# остальные варианты поиска параллельно с ним
+_PRIMARY_SEARCH_TIMEOUT = 5.0
+
+def _doc_to_dict(doc) -> dict:
+    """Преобразует документ в источник для ответа rag_search."""
+    meta = doc.metadata
+    source_data = {
+        "source": meta.get("source", "Unknown"),
+        "page_content": doc.page_content  # Полный текст документа
+    }
+    # page только для PDF (у JSON документов его нет)
+    page = meta.get("page")
+    if page is not None:
+        source_data["page"] = page
+    return source_data
+
+
 @tool
 def rag_search(query: str) -> str:
     """
@@ -32,30 +101,26 @@ def rag_search(query: str) -> str:
         documents = rag.retrieve_documents(query)
         
         if not documents:
-            return json.dumps({"sources": []}, ensure_ascii=False)
+            return _dumps({"sources": []})
         
         # Формируем структурированный ответ для агента
-        sources = []
-        for doc in documents:
-            source_data = {
-                "source": doc.metadata.get("source", "Unknown"),
-                "page_content": doc.page_content  # Полный текст документа
-            }
-            # page только для PDF (у JSON документов его нет)
-            if "page" in doc.metadata:
-                source_data["page"] = doc.metadata["page"]
-            sources.append(source_data)
+        sources = [_doc_to_dict(doc) for doc in documents]
         
-        # ensure_ascii=False для корректной кириллицы
-        return json.dumps({"sources": sources}, ensure_ascii=False)
+        return _dumps({"sources": sources})
         
     except Exception as e:
         logger.error(f"Error in rag_search: {e}", exc_info=True)
-        return json.dumps({"sources": []}, ensure_ascii=False)
+        return _dumps({"sources": []})
+
+
+# Клиент Tavily переиспользуется между вызовами, чтобы не терять keep-alive соединения
+_TAVILY_CLIENT: "TavilyClient | None" = None
+_TAVILY_CLIENT_KEY: str | None = None
 
 
 def _get_tavily_client() -> "TavilyClient":
-    """Создает Tavily клиент и валидирует конфигурацию."""
+    """Возвращает общий Tavily клиент, создавая его при первом вызове или смене ключа."""
+    global _TAVILY_CLIENT, _TAVILY_CLIENT_KEY
     if TavilyClient is None:
         raise RuntimeError(
             "Пакет tavily-python не установлен. Добавьте его в зависимости перед использованием Tavily."
@@ -63,76 +128,107 @@ def _get_tavily_client() -> "TavilyClient":
     api_key = os.getenv("TAVILY_API_KEY")
     if not api_key:
         raise RuntimeError("Не найден TAVILY_API_KEY в окружении.")
-    return TavilyClient(api_key=api_key)
+    if _TAVILY_CLIENT is None or _TAVILY_CLIENT_KEY != api_key:
+        _TAVILY_CLIENT = TavilyClient(api_key=api_key)
+        _TAVILY_CLIENT_KEY = api_key
+    return _TAVILY_CLIENT
+
+
+def _parse_number_strict(value: str) -> float:
+    """Преобразует в float строку, уже совпавшую с группой num в _TOKEN_RE."""
+    return float(value.translate(_COMMA_TO_DOT))
 
 
 def _parse_number(value: str) -> float | None:
     """Преобразует строку с числом в float, поддерживает запятые."""
     try:
-        normalized = value.replace(",", ".").strip()
-        return float(normalized)
+        # float() сам игнорирует пробелы по краям
+        return float(value.translate(_COMMA_TO_DOT))
     except Exception:
         return None
 
 
-def _parse_rates_from_text(text: str) -> dict[str, dict[str, float]]:
+def _valid_rate(rate: float | None) -> bool:
+    """Санити-чек значений (отсекаем явно некорректные 1-5 руб)."""
+    return rate is not None and 10.0 <= rate <= 300.0
+
+
+def _mentions_currency(text: str) -> bool:
+    """Проверяет, упоминается ли в тексте хотя бы одна из поддерживаемых валют."""
+    lower = text.lower()
+    return any(token in lower for token in _CURRENCY_TOKENS)
+
+
+def _is_label_gap(gap: str) -> bool:
+    """Проверяет, что между меткой и числом нет цифр и не больше _LABEL_GAP значимых символов."""
+    if any(ch.isdigit() for ch in gap):
+        return False
+    if len(gap) <= _LABEL_GAP:
+        return True
+    # Переносы строк и отступы из raw_content не считаем
+    return sum(not ch.isspace() for ch in gap) <= _LABEL_GAP
+
+
+def _parse_rates_from_text(text: str) -> dict[str, Rate]:
     """
     Извлекает курсы валют из текста Tavily (ожидаем блоки с покупкой/продажей).
     
-    Возвращает словарь вида {"USD": {"buy": 00.00, "sell": 00.00}, ...}
+    Возвращает словарь вида {"USD": Rate(buy=00.00, sell=00.00), ...}
     """
-    if not text:
+    # Страницы без упоминания валют отсекаем без регулярных выражений
+    if not text or not _mentions_currency(text):
         return {}
     
-    normalized = re.sub(r"\s+", " ", text)
-    normalized_lower = normalized.lower()
-    currency_aliases = {
-        "USD": [r"USD", r"Доллар[^A-Za-z0-9]{0,3}США", r"Доллара?"],
-        "EUR": [r"EUR", r"Евро"],
-    }
-    buy_labels = {"покупка", "buy", "продать"}  # банк покупает валюту, пользователь продает
-    sell_labels = {"продажа", "sell", "купить"}  # банк продает валюту, пользователь покупает
+    # Для каждой валюты: курсы по меткам и первые два числа рядом с названием (фолбек)
+    found = {code: {"buy": None, "sell": None, "numbers": []} for code in _CURRENCY_ALIASES}
+    current: dict | None = None
+    window_end = 0
+    label: str | None = None
+    label_end = 0
     
-    rates: dict[str, dict[str, float]] = {}
-    for code, aliases in currency_aliases.items():
-        alias_pattern = "|".join(aliases)
-        window_match = re.search(rf"(?:{alias_pattern}).{{0,320}}", normalized, flags=re.IGNORECASE)
-        window_text = normalized if window_match is None else normalized[window_match.start():window_match.end()]
-        
-        buy: float | None = None
-        sell: float | None = None
-        
-        # Ищем метки "Купить/Продать/Покупка/Продажа" перед числами
-        for match in re.finditer(r"(покупка|продажа|buy|sell|купить|продать)[^\d]{0,12}(\d+[.,]\d+)", window_text, flags=re.IGNORECASE):
-            label = match.group(1).lower()
-            number = _parse_number(match.group(2))
-            if number is None:
-                continue
-            if label in buy_labels and buy is None:
-                buy = number
-            elif label in sell_labels and sell is None:
-                sell = number
-            if buy is not None and sell is not None:
-                break
+    # Числа относим к последней упомянутой валюте, пока не вышли из ее окна
+    for match in _TOKEN_RE.finditer(text):
+        kind = match.lastgroup
+        if kind in found:
+            current = found[kind]
+            window_end = match.end() + _CURRENCY_WINDOW
+            label = None
+            continue
+        if current is None:
+            continue
+        if match.end() > window_end:
+            current = None
+            continue
+        if kind == "label":
+            label = match.group().lower()
+            label_end = match.end()
+            continue
         
+        # Группа num гарантирует корректное число, поэтому без try/except
+        number = _parse_number_strict(match.group())
+        if len(current["numbers"]) < 2:
+            current["numbers"].append(number)
+        # Метка "Купить/Продать/Покупка/Продажа" прямо перед числом
+        if label is not None and _is_label_gap(text[label_end:match.start()]):
+            if label in _BUY_LABELS and current["buy"] is None:
+                current["buy"] = number
+            elif label in _SELL_LABELS and current["sell"] is None:
+                current["sell"] = number
+        label = None
+    
+    rates: dict[str, Rate] = {}
+    for code, data in found.items():
+        buy, sell = data["buy"], data["sell"]
         # Фолбек: берем первые два числа около названия валюты
-        if buy is None or sell is None:
-            numbers = [n for n in re.findall(r"(\d+[.,]\d+)", window_text)]
-            if len(numbers) >= 2:
-                buy = _parse_number(numbers[0])
-                sell = _parse_number(numbers[1])
-        
-        # Санити-чек значений (отсекаем явно некорректные 1-5 руб)
-        def _valid(rate: float | None) -> bool:
-            return rate is not None and 10.0 <= rate <= 300.0
-        
-        if _valid(buy) and _valid(sell):
-            rates[code] = {"buy": buy, "sell": sell}
+        if (buy is None or sell is None) and len(data["numbers"]) >= 2:
+            buy, sell = data["numbers"]
+        if _valid_rate(buy) and _valid_rate(sell):
+            rates[code] = Rate(buy, sell)
     
     return rates
 
 
-def _fetch_sberbank_rates() -> dict[str, dict[str, float]]:
+def _fetch_sberbank_rates() -> dict[str, Rate]:
     """
     Получает курсы валют через Tavily с сайта Сбербанк Онлайн (вкладка СБОЛ).
     
@@ -144,39 +240,39 @@ def _fetch_sberbank_rates() -> dict[str, dict[str, float]]:
         "курс доллара евро сегодня Сбербанк Онлайн купить продать",
     ]
     
-    def _search(query: str, include_sber: bool):
+    def _search(query: str, include_sber: bool, cheap: bool):
+        # Дешевый запрос: без raw_content и с меньшим числом результатов -
+        # обычно answer и content со страницы Сбербанка уже содержат курсы
         kwargs = {
             "query": query,
             "search_depth": "advanced",
-            "max_results": 8,
+            "max_results": 3 if cheap else 8,
             "include_answer": True,
-            "include_raw_content": True,
+            "include_raw_content": not cheap,
         }
         if include_sber:
             kwargs["include_domains"] = ["www.sberbank.ru", "sberbank.ru"]
         return client.search(**kwargs)
     
-    def _try_parse(search_result: dict) -> dict[str, dict[str, float]]:
+    def _try_parse(search_result: dict) -> dict[str, Rate]:
         results = search_result.get("results", []) or []
         
-        # 1) приоритетно парсим результаты с доменом sberbank.ru
+        # Один проход по результатам: тексты в исходном порядке с приоритетом
+        # 0 для домена sberbank.ru и 1 для остальных
+        candidates = []
         for res in results:
-            url = (res.get("url") or "").lower()
-            if "sberbank.ru" not in url:
-                continue
+            priority = 0 if "sberbank.ru" in (res.get("url") or "").lower() else 1
             for key in ("raw_content", "content"):
-                text = res.get(key) or ""
-                rates = _parse_rates_from_text(text)
-                if rates:
-                    return rates
+                val = res.get(key)
+                if val:
+                    candidates.append((priority, val))
         
-        # 2) парсим все остальные результаты
-        for res in results:
-            for key in ("raw_content", "content"):
-                text = res.get(key) or ""
-                rates = _parse_rates_from_text(text)
-                if rates:
-                    return rates
+        # 1) приоритетно парсим результаты с доменом sberbank.ru, 2) затем остальные
+        # (сортировка устойчивая, порядок внутри приоритета сохраняется)
+        for _, text in sorted(candidates, key=lambda item: item[0]):
+            rates = _parse_rates_from_text(text)
+            if rates:
+                return rates
         
         # 3) answer от Tavily
         answer = search_result.get("answer", "") or ""
@@ -185,33 +281,60 @@ def _fetch_sberbank_rates() -> dict[str, dict[str, float]]:
             return rates
         
         # 4) агрегируем все тексты
-        texts = []
-        for res in results:
-            for key in ("raw_content", "content"):
-                val = res.get(key)
-                if val:
-                    texts.append(val)
-        combined = " ".join(texts)
-        return _parse_rates_from_text(combined)
+        return _parse_rates_from_text(" ".join(text for _, text in candidates))
     
-    for query in queries:
-        # Сначала строго по домену Сбербанк
-        result = _search(query, include_sber=True)
-        rates = _try_parse(result)
-        if rates:
-            return rates
+    def _result_rates(future) -> dict[str, Rate]:
+        try:
+            return _try_parse(future.result())
+        except Exception as e:
+            logger.warning(f"Tavily search failed: {e}")
+            return {}
+    
+    # Сначала волна дешевых запросов, полные страницы запрашиваем только при промахе.
+    # В каждой волне сначала один запрос строго по домену Сбербанк - обычно его
+    # достаточно. Остальные варианты (без ограничения доменов, второй запрос)
+    # запускаем параллельно только при промахе или если основной запрос завис.
+    for cheap in (True, False):
+        primary = _TAVILY_EXECUTOR.submit(_search, queries[0], True, cheap)
+        pending = [primary]
+        if wait(pending, timeout=_PRIMARY_SEARCH_TIMEOUT).done:
+            rates = _result_rates(primary)
+            if rates:
+                return rates
+            pending = []
         
-        # Фолбек: шире поиск без ограничения доменов
-        result = _search(query, include_sber=False)
-        rates = _try_parse(result)
-        if rates:
-            return rates
+        # Разбираем в порядке приоритета; зависший основной запрос - первым
+        pending += [
+            _TAVILY_EXECUTOR.submit(_search, query, include_sber, cheap)
+            for query, include_sber in (
+                (queries[0], False),
+                (queries[1], True),
+                (queries[1], False),
+            )
+        ]
+        for future in pending:
+            rates = _result_rates(future)
+            if rates:
+                return rates
     
     logger.warning("Не удалось получить курсы валют через Tavily.")
     return {}
 
 
-def _convert_amount(amount: float, from_currency: str, to_currency: str, rates: dict[str, dict[str, float]]) -> tuple[float, list[str]]:
+def _cached_rates() -> dict[str, Rate]:
+    """Возвращает курсы из кеша, если они не старше _RATES_TTL, иначе запрашивает заново."""
+    global _RATES_CACHE
+    now = time.monotonic()
+    if _RATES_CACHE is not None and now - _RATES_CACHE[0] < _RATES_TTL:
+        return _RATES_CACHE[1]
+    rates = _fetch_sberbank_rates()
+    # Пустой результат не кешируем, чтобы следующий вызов попробовал снова
+    if rates:
+        _RATES_CACHE = (now, rates)
+    return rates
+
+
+def _convert_amount(amount: float, from_currency: str, to_currency: str, rates: dict[str, Rate]) -> tuple[float, list[str]]:
     """
     Конвертирует сумму используя купля/продажа относительно RUB.
     
@@ -225,20 +348,20 @@ def _convert_amount(amount: float, from_currency: str, to_currency: str, rates:
         return amount, steps
     
     if from_currency == "RUB":
-        sell_rate = rates[to_currency]["sell"]
+        sell_rate = rates[to_currency].sell
         result = amount / sell_rate
         steps.append(f"RUB -> {to_currency} по продаже {sell_rate:.4f}")
         return result, steps
     
     if to_currency == "RUB":
-        buy_rate = rates[from_currency]["buy"]
+        buy_rate = rates[from_currency].buy
         result = amount * buy_rate
         steps.append(f"{from_currency} -> RUB по покупке {buy_rate:.4f}")
         return result, steps
     
-    buy_rate = rates[from_currency]["buy"]
+    buy_rate = rates[from_currency].buy
     rub_amount = amount * buy_rate
-    sell_rate = rates[to_currency]["sell"]
+    sell_rate = rates[to_currency].sell
     result = rub_amount / sell_rate
     steps.extend([
         f"{from_currency} -> RUB по покупке {buy_rate:.4f}",
@@ -253,14 +376,14 @@ def currency_rates() -> str:
     Возвращает текущие курсы покупки/продажи USD и EUR по Сбербанк Онлайн (вкладка СБОЛ).
     """
     try:
-        rates = _fetch_sberbank_rates()
+        rates = _cached_rates()
         if not rates:
             return "Не удалось получить курсы валют."
         
         parts = []
         for code in ("USD", "EUR"):
             if code in rates:
-                parts.append(f"{code}: покупка {rates[code]['buy']:.2f}₽, продажа {rates[code]['sell']:.2f}₽")
+                parts.append(f"{code}: покупка {rates[code].buy:.2f}₽, продажа {rates[code].sell:.2f}₽")
         if not parts:
             return "Не удалось разобрать курсы валют."
         return "Актуальные курсы СБОЛ: " + "; ".join(parts)
@@ -292,10 +415,10 @@ def tavily_search(query: str) -> str:
                 "content": item.get("content"),
             })
         
-        return json.dumps({"results": results}, ensure_ascii=False)
+        return _dumps({"results": results})
     except Exception as e:
         logger.error(f"Error in tavily_search: {e}", exc_info=True)
-        return json.dumps({"results": []}, ensure_ascii=False)
+        return _dumps({"results": []})
 
 
 @tool
@@ -317,20 +440,22 @@ def currency_converter(amount: float = 1.0, from_currency: str = "USD", to_curre
         
         from_cur = from_currency.upper()
         to_cur = to_currency.upper()
-        supported = {"USD", "EUR", "RUB"}
-        if from_cur not in supported or to_cur not in supported:
+        if from_cur not in _SUPPORTED_CURRENCIES or to_cur not in _SUPPORTED_CURRENCIES:
             return "Поддерживаемые валюты: USD, EUR, RUB."
         
-        rates = _fetch_sberbank_rates()
+        rates = _cached_rates()
         missing = [c for c in {from_cur, to_cur} if c != "RUB" and c not in rates]
         if missing:
             return f"Не удалось получить курсы: {', '.join(missing)}."
         
         converted, steps = _convert_amount(amount, from_cur, to_cur, rates)
         
+        # Показываем курсы только участвующих в конвертации валют
         rate_info_parts = []
-        for code, data in rates.items():
-            rate_info_parts.append(f"{code}: покупка {data['buy']:.2f}₽ / продажа {data['sell']:.2f}₽")
+        for code in dict.fromkeys((from_cur, to_cur)):
+            if code in rates:
+                data = rates[code]
+                rate_info_parts.append(f"{code}: покупка {data.buy:.2f}₽ / продажа {data.sell:.2f}₽")
         rate_info = "; ".join(rate_info_parts)
         
         details = f"Шаги конвертации: {'; '.join(steps)}." if steps else "Шаги конвертации: без изменений валюты."
@@ -12,11 +12,19 @@ Bank Agent MCP Server
 """
 import json
 import logging
+import math
 import os
+import time
+from functools import lru_cache
+from collections import defaultdict
 from pathlib import Path
 from typing import Annotated, Literal
-import requests
+import httpx
 from pydantic import Field
+try:
+    import orjson
+except ImportError:  # orjson не установлен — используем стандартный json
+    orjson = None
 
 from mcp.server.fastmcp import FastMCP
 
@@ -30,18 +38,86 @@ PRODUCTS_DB_PATH = Path(__file__).parent / "data" / "bank_products.json"
 # CBR API endpoint
 CBR_API_URL = "https://www.cbr-xml-daily.ru/latest.js"
 
+# ЦБ обновляет курсы раз в день, поэтому храним их час
+CBR_RATES_TTL = 3600
+# Кеш курсов: (время получения по time.monotonic, курсы)
+_rates_cache: tuple[float, dict] | None = None
+# Сколько продуктов возвращает search_products
+SEARCH_RESULTS_LIMIT = 10
+
+# Общий HTTP клиент: соединение с API ЦБ переиспользуется между вызовами
+_http_client: httpx.AsyncClient | None = None
+
+
+# Кеш базы продуктов: (mtime файла, список продуктов, индексы по категориальным полям)
+_products_cache: tuple[int, list[dict], dict[str, dict[str, list[int]]]] | None = None
+
+
+# Длина n-грамм в индексе для поиска по ключевому слову
+KEYWORD_NGRAM = 3
+
+
+def _ngrams(text: str) -> set[str]:
+    """Множество подстрок длины KEYWORD_NGRAM."""
+    return {text[i:i + KEYWORD_NGRAM] for i in range(len(text) - KEYWORD_NGRAM + 1)}
+
+
+def build_product_indexes(products: list[dict]) -> dict[str, dict[str, list[int]]]:
+    """
+    Строит индексы значение -> номера продуктов для product_type и currency.
+    
+    Поле currency может содержать несколько валют через запятую ("RUB,USD,EUR").
+    Заодно сохраняет в продуктах название и описание в нижнем регистре
+    (_name_lower, _desc_lower) и строит по ним индекс триграмм: подстрока
+    длины от KEYWORD_NGRAM может быть только в продуктах, содержащих все ее триграммы.
+    """
+    by_type: dict[str, list[int]] = defaultdict(list)
+    by_currency: dict[str, list[int]] = defaultdict(list)
+    by_ngram: dict[str, set[int]] = defaultdict(set)
+    for i, product in enumerate(products):
+        product['_name_lower'] = product.get('name', '').lower()
+        product['_desc_lower'] = product.get('description', '').lower()
+        for gram in _ngrams(product['_name_lower']) | _ngrams(product['_desc_lower']):
+            by_ngram[gram].add(i)
+        by_type[product.get('product_type')].append(i)
+        for code in product.get('currency', '').split(','):
+            if code.strip():
+                by_currency[code.strip()].append(i)
+    return {"product_type": dict(by_type), "currency": dict(by_currency), "ngram": dict(by_ngram)}
+
+
+def get_product_indexes(products: list[dict]) -> dict[str, dict[str, list[int]]]:
+    """Возвращает индексы из кеша, если список продуктов из него, иначе строит заново."""
+    if _products_cache is not None and _products_cache[1] is products:
+        return _products_cache[2]
+    return build_product_indexes(products)
+
 
 def load_products() -> list[dict]:
-    """Загрузка продуктов банка из JSON файла."""
+    """
+    Загрузка продуктов банка из JSON файла.
+    
+    Файл перечитывается только при изменении (по mtime), иначе возвращается кеш.
+    """
+    global _products_cache
     try:
         if not PRODUCTS_DB_PATH.exists():
             logger.error(f"Products database not found at {PRODUCTS_DB_PATH}")
             return []
         
-        with open(PRODUCTS_DB_PATH, 'r', encoding='utf-8') as f:
-            products = json.load(f)
+        mtime = PRODUCTS_DB_PATH.stat().st_mtime_ns
+        if _products_cache is not None and _products_cache[0] == mtime:
+            return _products_cache[1]
+        
+        if orjson is not None:
+            # orjson разбирает UTF-8 байты напрямую, без промежуточной str
+            products = orjson.loads(PRODUCTS_DB_PATH.read_bytes())
+        else:
+            with open(PRODUCTS_DB_PATH, 'r', encoding='utf-8') as f:
+                products = json.load(f)
         
         logger.info(f"Loaded {len(products)} products from database")
+        _products_cache = (mtime, products, build_product_indexes(products))
         return products
     except Exception as e:
         logger.error(f"Error loading products: {e}")
@@ -56,47 +132,57 @@ def filter_products(
     max_amount: int | None = None,
     min_rate: float | None = None,
     max_rate: float | None = None,
-    currency: str | None = None
+    currency: str | None = None,
+    limit: int | None = None
 ) -> list[dict]:
     """
     Фильтрация продуктов по параметрам
     
-    Использует list comprehension для простоты (следуя принципу KISS).
+    Тип продукта, валюта и триграммы ключевого слова отбираются по индексам
+    (пересечение списков номеров), затем один проход по кандидатам: сначала дешевые
+    числовые условия, последней - проверка подстроки (триграммы дают лишь кандидатов).
+    Проход останавливается, набрав limit продуктов.
     """
-    filtered = products
+    indexes = get_product_indexes(products)
+    keyword_lower = keyword.lower() if keyword else None
     
-    # Фильтр по типу продукта
+    # Сужаем кандидатов по индексам: тип продукта, валюта, триграммы ключевого слова
+    candidate_ids: set[int] | None = None
     if product_type:
-        filtered = [p for p in filtered if p.get('product_type') == product_type]
-    
-    # Поиск по ключевому слову (в названии и описании)
-    if keyword:
-        keyword_lower = keyword.lower()
-        filtered = [
-            p for p in filtered
-            if keyword_lower in p.get('name', '').lower() or 
-               keyword_lower in p.get('description', '').lower()
-        ]
-    
-    # Фильтр по минимальной сумме
-    if min_amount is not None:
-        filtered = [p for p in filtered if p.get('amount_min', 0) <= min_amount]
-    
-    # Фильтр по максимальной сумме
-    if max_amount is not None:
-        filtered = [p for p in filtered if p.get('amount_max', float('inf')) >= max_amount]
-    
-    # Фильтр по минимальной ставке
-    if min_rate is not None:
-        filtered = [p for p in filtered if p.get('rate_max', 0) >= min_rate]
-    
-    # Фильтр по максимальной ставке
-    if max_rate is not None:
-        filtered = [p for p in filtered if p.get('rate_min', float('inf')) <= max_rate]
-    
-    # Фильтр по валюте
+        candidate_ids = set(indexes["product_type"].get(product_type, ()))
     if currency:
-        filtered = [p for p in filtered if currency in p.get('currency', '')]
+        currency_ids = set(indexes["currency"].get(currency, ()))
+        candidate_ids = currency_ids if candidate_ids is None else candidate_ids & currency_ids
+    if keyword_lower and len(keyword_lower) >= KEYWORD_NGRAM:
+        for gram in _ngrams(keyword_lower):
+            gram_ids = indexes["ngram"].get(gram, set())
+            candidate_ids = set(gram_ids) if candidate_ids is None else candidate_ids & gram_ids
+            if not candidate_ids:
+                break
+    candidates = products if candidate_ids is None else [products[i] for i in sorted(candidate_ids)]
+    
+    filtered = []
+    for p in candidates:
+        # Фильтры по сумме
+        if min_amount is not None and p.get('amount_min', 0) > min_amount:
+            continue
+        if max_amount is not None and p.get('amount_max', float('inf')) < max_amount:
+            continue
+        # Фильтры по ставке
+        if min_rate is not None and p.get('rate_max', 0) < min_rate:
+            continue
+        if max_rate is not None and p.get('rate_min', float('inf')) > max_rate:
+            continue
+        # Поиск по ключевому слову (в названии и описании)
+        if keyword_lower and not (
+            keyword_lower in p['_name_lower'] or
+            keyword_lower in p['_desc_lower']
+        ):
+            continue
+        
+        filtered.append(p)
+        if limit is not None and len(filtered) >= limit:
+            break
     
     return filtered
 
@@ -113,60 +199,84 @@ def format_products(products: list[dict], limit: int = 10) -> str:
     # Ограничиваем количество результатов
     products = products[:limit]
     
-    result = f"Найдено {len(products)} продукт(ов):\n\n"
+    parts = [f"Найдено {len(products)} продукт(ов):\n\n"]
     
     for i, product in enumerate(products, 1):
-        result += f"**{i}. {product.get('name')}**\n"
-        result += f"   Описание: {product.get('description')}\n"
+        parts.append(f"**{i}. {product.get('name')}**\n")
+        parts.append(f"   Описание: {product.get('description')}\n")
         
         # Ставка (для вкладов и кредитов)
         rate_min = product.get('rate_min', 0)
         rate_max = product.get('rate_max', 0)
         if rate_min > 0 or rate_max > 0:
             if rate_min == rate_max:
-                result += f"   Ставка: {rate_min}% годовых\n"
+                parts.append(f"   Ставка: {rate_min}% годовых\n")
             else:
-                result += f"   Ставка: от {rate_min}% до {rate_max}% годовых\n"
+                parts.append(f"   Ставка: от {rate_min}% до {rate_max}% годовых\n")
         
         # Сумма
         amount_min = product.get('amount_min', 0)
         amount_max = product.get('amount_max', 0)
         if amount_min > 0 or amount_max > 0:
             if amount_max > 0:
-                result += f"   Сумма: от {amount_min:,} до {amount_max:,} {product.get('currency', 'RUB')}\n"
+                parts.append(f"   Сумма: от {amount_min:,} до {amount_max:,} {product.get('currency', 'RUB')}\n")
             else:
-                result += f"   Сумма: от {amount_min:,} {product.get('currency', 'RUB')}\n"
+                parts.append(f"   Сумма: от {amount_min:,} {product.get('currency', 'RUB')}\n")
         
         # Срок
         term = product.get('term_months', '')
         if term:
-            result += f"   Срок: {term} месяцев\n"
+            parts.append(f"   Срок: {term} месяцев\n")
         
         # Особенности
         features = product.get('features', [])
         if features:
-            result += f"   Особенности: {', '.join(features)}\n"
+            parts.append(f"   Особенности: {', '.join(features)}\n")
         
-        result += "\n"
+        parts.append("\n")
     
-    return result
+    return "".join(parts)
 
 
-def get_exchange_rates() -> dict:
+def _get_http_client() -> httpx.AsyncClient:
+    """Возвращает общий асинхронный HTTP клиент, создавая его при первом вызове."""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=5.0)
+    return _http_client
+
+
+async def get_exchange_rates() -> dict:
     """
     Получение курсов валют от ЦБ РФ
     
     API возвращает курсы относительно рубля (base: RUB).
     Например: {"USD": 0.0124} означает 1 RUB = 0.0124 USD (или 1 USD ≈ 80.6 RUB)
+    
+    Курсы кешируются на CBR_RATES_TTL секунд. Если API недоступно,
+    возвращаются последние полученные курсы (даже устаревшие).
     """
+    global _rates_cache
+    now = time.monotonic()
+    if _rates_cache is not None and now - _rates_cache[0] < CBR_RATES_TTL:
+        return _rates_cache[1]
+    
     try:
-        response = requests.get(CBR_API_URL, timeout=5)
+        # Асинхронный запрос не блокирует event loop FastMCP на время ожидания ответа
+        response = await _get_http_client().get(CBR_API_URL)
         response.raise_for_status()
-        data = response.json()
-        return data.get('rates', {})
-    except requests.RequestException as e:
+        data = orjson.loads(response.content) if orjson is not None else response.json()
+        rates = data.get('rates', {})
+    except (httpx.HTTPError, ValueError) as e:
         logger.error(f"Error fetching exchange rates: {e}")
+        if _rates_cache is not None:
+            logger.warning("Using stale exchange rates from cache")
+            return _rates_cache[1]
         return {}
+    
+    if rates:
+        _rates_cache = (now, rates)
+    return rates
 
 
 def convert_currency(
@@ -254,6 +364,50 @@ def calculate_monthly_payment(
     return principal * monthly_rate / (1 - (1 + monthly_rate) ** (-months))
 
 
+def remaining_balance(
+    balance: float,
+    monthly_payment: float,
+    monthly_rate: float,
+    months: int
+) -> float:
+    """
+    Остаток долга после months платежей (без учёта досрочного погашения).
+    
+    Формула: B_k = B * (1 + r)^k - A * ((1 + r)^k - 1) / r
+    """
+    if monthly_rate == 0:
+        return balance - monthly_payment * months
+    growth = (1 + monthly_rate) ** months
+    return balance * growth - monthly_payment * (growth - 1) / monthly_rate
+
+
+def payoff_months(
+    balance: float,
+    monthly_payment: float,
+    monthly_rate: float
+) -> int:
+    """
+    Число платежей до полного погашения.
+    
+    Формула: n = ceil(-log(1 - B * r / A) / log(1 + r)). Платеж должен покрывать проценты.
+    """
+    if monthly_payment - balance * monthly_rate <= 0:
+        raise ValueError("Ежемесячный платеж меньше начисленных процентов")
+    
+    if monthly_rate == 0:
+        months = math.ceil(balance / monthly_payment)
+    else:
+        months = math.ceil(
+            -math.log(1 - balance * monthly_rate / monthly_payment) / math.log(1 + monthly_rate)
+        )
+    months = max(months, 1)
+    # Поправка на погрешность округления около целого числа месяцев
+    tolerance = max(1e-6, balance * 1e-9)
+    if months > 1 and remaining_balance(balance, monthly_payment, monthly_rate, months - 1) <= tolerance:
+        months -= 1
+    return months
+
+
 def amortize(
     balance: float,
     monthly_payment: float,
@@ -261,37 +415,25 @@ def amortize(
     months_limit: int
 ) -> tuple[float, int, float, float]:
     """
-    Проводит расчёт помесячно с заданным платежом.
-
+    Проводит расчёт на months_limit месяцев с заданным платежом (в замкнутой форме).
+    
+    Если кредит гасится раньше, расчёт останавливается на последнем платеже.
+    
     Returns:
         (остаток, месяцев прошло, выплаченные проценты, выплаченная сумма)
     """
-    total_interest = 0.0
-    total_paid = 0.0
-    months_passed = 0
+    if balance <= 1e-6 or months_limit <= 0:
+        return balance, 0, 0.0, 0.0
     
-    for _ in range(months_limit):
-        if balance <= 1e-6:
-            break
-        
-        months_passed += 1
-        interest = balance * monthly_rate
-        principal_payment = monthly_payment - interest
-        
-        if principal_payment <= 0:
-            raise ValueError("Ежемесячный платеж меньше начисленных процентов")
-        
-        if principal_payment > balance:
-            principal_payment = balance
-            payment_fact = interest + principal_payment
-        else:
-            payment_fact = monthly_payment
-        
-        balance -= principal_payment
-        total_interest += interest
-        total_paid += payment_fact
+    months_to_payoff = payoff_months(balance, monthly_payment, monthly_rate)
+    if months_to_payoff <= months_limit:
+        months_used, total_interest, total_paid = amortize_full(balance, monthly_payment, monthly_rate)
+        return 0.0, months_used, total_interest, total_paid
     
-    return balance, months_passed, total_interest, total_paid
+    balance_left = remaining_balance(balance, monthly_payment, monthly_rate, months_limit)
+    total_paid = monthly_payment * months_limit
+    total_interest = total_paid - (balance - balance_left)
+    return balance_left, months_limit, total_interest, total_paid
 
 
 def amortize_full(
@@ -302,37 +444,135 @@ def amortize_full(
 ) -> tuple[int, float, float]:
     """
     Доводит расчёт до полного погашения или сообщает, что платеж не покрывает проценты.
+    
+    Считается в замкнутой форме, без помесячного цикла (см. payoff_months).
+    Последний платеж равен остатку с процентами: B_{n-1} * (1 + r).
     """
-    total_interest = 0.0
-    total_paid = 0.0
-    months_used = 0
-    
-    while balance > 1e-6 and months_used < max_months:
-        months_used += 1
-        interest = balance * monthly_rate
-        principal_payment = monthly_payment - interest
-        
-        if principal_payment <= 0:
-            raise ValueError("Ежемесячный платеж меньше начисленных процентов")
-        
-        if principal_payment > balance:
-            principal_payment = balance
-            payment_fact = interest + principal_payment
-        else:
-            payment_fact = monthly_payment
-        
-        balance -= principal_payment
-        total_interest += interest
-        total_paid += payment_fact
+    if balance <= 1e-6:
+        return 0, 0.0, 0.0
     
-    if balance > 1e-6:
+    months_used = payoff_months(balance, monthly_payment, monthly_rate)
+    if months_used > max_months:
         raise ValueError("Не удалось погасить кредит за разумный срок — проверьте параметры")
     
+    last_payment = remaining_balance(balance, monthly_payment, monthly_rate, months_used - 1) * (1 + monthly_rate)
+    total_paid = monthly_payment * (months_used - 1) + last_payment
+    total_interest = total_paid - balance
     return months_used, total_interest, total_paid
 
 
+@lru_cache(maxsize=1024)
+def calculate_early_repayment(
+    loan_amount: float,
+    annual_rate: float,
+    term_months: int,
+    early_payment: float,
+    month_number: int,
+    strategy: str,
+    currency: str
+) -> str:
+    """
+    Расчёт для early_repayment_calculator.
+    
+    Результат зависит только от аргументов, поэтому кешируется:
+    повторные вопросы с теми же параметрами отвечаются без пересчёта.
+    """
+    try:
+        if month_number > term_months:
+            return "Номер месяца досрочного платежа не может быть больше срока кредита"
+        
+        monthly_rate = annual_rate / 12 / 100
+        base_payment = calculate_monthly_payment(loan_amount, monthly_rate, term_months)
+        base_total_interest = base_payment * term_months - loan_amount
+        
+        # Платежи до момента досрочного погашения
+        balance_after_regular, months_passed, interest_before, payments_before = amortize(
+            loan_amount,
+            base_payment,
+            monthly_rate,
+            min(month_number, term_months)
+        )
+        
+        if months_passed < month_number and balance_after_regular <= 1e-6:
+            return "Кредит будет погашен раньше выбранного месяца, досрочный платеж не требуется."
+        
+        balance_before_extra = balance_after_regular
+        balance_after_extra = max(balance_before_extra - early_payment, 0)
+        
+        total_interest = interest_before
+        total_paid = payments_before + early_payment
+        
+        if balance_after_extra <= 1e-6:
+            interest_saved = max(base_total_interest - total_interest, 0)
+            return (
+                "Долг полностью погашен за счёт досрочного платежа.\n\n"
+                f"Базовый ежемесячный платёж: {base_payment:,.2f} {currency}\n"
+                f"Проценты по графику: {base_total_interest:,.2f} {currency}\n"
+                f"Фактически заплатите процентов: {total_interest:,.2f} {currency}\n"
+                f"Экономия на процентах: {interest_saved:,.2f} {currency}\n"
+                f"Всего выплатите: {total_paid:,.2f} {currency}"
+            )
+        
+        if strategy == "reduce_payment":
+            remaining_months = max(term_months - months_passed, 1)
+            new_payment = calculate_monthly_payment(balance_after_extra, monthly_rate, remaining_months)
+            
+            interest_after = new_payment * remaining_months - balance_after_extra
+            interest_after = max(interest_after, 0.0)
+            
+            total_interest += interest_after
+            total_paid += new_payment * remaining_months
+            total_months = months_passed + remaining_months
+            
+            interest_saved = max(base_total_interest - total_interest, 0.0)
+            payment_diff = base_payment - new_payment
+            
+            return (
+                "Стратегия: уменьшаем ежемесячный платёж, срок остаётся прежним.\n\n"
+                f"Базовый платёж: {base_payment:,.2f} {currency}\n"
+                f"Новый платёж после досрочного: {new_payment:,.2f} {currency} "
+                f"(изменение: {'-' if payment_diff >= 0 else '+'}{abs(payment_diff):,.2f})\n"
+                f"Проценты по графику: {base_total_interest:,.2f} {currency}\n"
+                f"Проценты с учётом досрочного: {total_interest:,.2f} {currency}\n"
+                f"Экономия на процентах: {interest_saved:,.2f} {currency}\n"
+                f"Всего выплатите: {total_paid:,.2f} {currency}\n"
+                f"Осталось платить месяцев: {remaining_months} (общий срок: {total_months} мес)"
+            )
+        
+        # strategy == reduce_term
+        months_after, interest_after, payments_after = amortize_full(
+            balance_after_extra,
+            base_payment,
+            monthly_rate,
+            max_months=term_months * 2
+        )
+        
+        total_interest += interest_after
+        total_paid += payments_after
+        total_months = months_passed + months_after
+        months_saved = max(term_months - total_months, 0)
+        
+        interest_saved = max(base_total_interest - total_interest, 0.0)
+        
+        return (
+            "Стратегия: сокращаем срок, платёж остаётся прежним.\n\n"
+            f"Базовый платёж: {base_payment:,.2f} {currency}\n"
+            f"Остаток перед досрочным: {balance_before_extra:,.2f} {currency}\n"
+            f"Остаток после досрочного: {balance_after_extra:,.2f} {currency}\n"
+            f"Новый срок: {total_months} мес (экономия {months_saved} мес)\n"
+            f"Проценты по графику: {base_total_interest:,.2f} {currency}\n"
+            f"Проценты с учётом досрочного: {total_interest:,.2f} {currency}\n"
+            f"Экономия на процентах: {interest_saved:,.2f} {currency}\n"
+            f"Всего выплатите: {total_paid:,.2f} {currency}"
+        )
+    
+    except ValueError as e:
+        logger.error(f"early_repayment_calculator error: {e}")
+        return f"Ошибка в расчёте: {e}"
+
+
 # Create FastMCP server
-mcp = FastMCP("mcp-bank-agent", dependencies=["requests>=2.31.0"])
+mcp = FastMCP("mcp-bank-agent", dependencies=["httpx>=0.27.0"])
 
 
 @mcp.tool(
@@ -431,11 +671,12 @@ async def search_products(
         max_amount=max_amount,
         min_rate=min_rate,
         max_rate=max_rate,
-        currency=currency
+        currency=currency,
+        limit=SEARCH_RESULTS_LIMIT
     )
     
     # Форматируем результат
-    return format_products(filtered)
+    return format_products(filtered, limit=SEARCH_RESULTS_LIMIT)
 
 
 @mcp.tool(
@@ -481,7 +722,7 @@ async def currency_converter(
     logger.info(f"currency_converter called: {amount} {from_currency} -> {to_currency}")
     
     # Получаем актуальные курсы
-    rates = get_exchange_rates()
+    rates = await get_exchange_rates()
     
     # Конвертируем
     converted_amount, result_str = convert_currency(from_currency, to_currency, amount, rates)
@@ -565,98 +806,9 @@ async def early_repayment_calculator(
     logger.info("early_repayment_calculator called")
     currency = currency.upper()
     
-    try:
-        if month_number > term_months:
-            return "Номер месяца досрочного платежа не может быть больше срока кредита"
-        
-        monthly_rate = annual_rate / 12 / 100
-        base_payment = calculate_monthly_payment(loan_amount, monthly_rate, term_months)
-        base_total_interest = base_payment * term_months - loan_amount
-        
-        # Платежи до момента досрочного погашения
-        balance_after_regular, months_passed, interest_before, payments_before = amortize(
-            loan_amount,
-            base_payment,
-            monthly_rate,
-            min(month_number, term_months)
-        )
-        
-        if months_passed < month_number and balance_after_regular <= 1e-6:
-            return "Кредит будет погашен раньше выбранного месяца, досрочный платеж не требуется."
-        
-        balance_before_extra = balance_after_regular
-        balance_after_extra = max(balance_before_extra - early_payment, 0)
-        
-        total_interest = interest_before
-        total_paid = payments_before + early_payment
-        
-        if balance_after_extra <= 1e-6:
-            interest_saved = max(base_total_interest - total_interest, 0)
-            return (
-                "Долг полностью погашен за счёт досрочного платежа.\n\n"
-                f"Базовый ежемесячный платёж: {base_payment:,.2f} {currency}\n"
-                f"Проценты по графику: {base_total_interest:,.2f} {currency}\n"
-                f"Фактически заплатите процентов: {total_interest:,.2f} {currency}\n"
-                f"Экономия на процентах: {interest_saved:,.2f} {currency}\n"
-                f"Всего выплатите: {total_paid:,.2f} {currency}"
-            )
-        
-        if strategy == "reduce_payment":
-            remaining_months = max(term_months - months_passed, 1)
-            new_payment = calculate_monthly_payment(balance_after_extra, monthly_rate, remaining_months)
-            
-            interest_after = new_payment * remaining_months - balance_after_extra
-            interest_after = max(interest_after, 0.0)
-            
-            total_interest += interest_after
-            total_paid += new_payment * remaining_months
-            total_months = months_passed + remaining_months
-            
-            interest_saved = max(base_total_interest - total_interest, 0.0)
-            payment_diff = base_payment - new_payment
-            
-            return (
-                "Стратегия: уменьшаем ежемесячный платёж, срок остаётся прежним.\n\n"
-                f"Базовый платёж: {base_payment:,.2f} {currency}\n"
-                f"Новый платёж после досрочного: {new_payment:,.2f} {currency} "
-                f"(изменение: {'-' if payment_diff >= 0 else '+'}{abs(payment_diff):,.2f})\n"
-                f"Проценты по графику: {base_total_interest:,.2f} {currency}\n"
-                f"Проценты с учётом досрочного: {total_interest:,.2f} {currency}\n"
-                f"Экономия на процентах: {interest_saved:,.2f} {currency}\n"
-                f"Всего выплатите: {total_paid:,.2f} {currency}\n"
-                f"Осталось платить месяцев: {remaining_months} (общий срок: {total_months} мес)"
-            )
-        
-        # strategy == reduce_term
-        months_after, interest_after, payments_after = amortize_full(
-            balance_after_extra,
-            base_payment,
-            monthly_rate,
-            max_months=term_months * 2
-        )
-        
-        total_interest += interest_after
-        total_paid += payments_after
-        total_months = months_passed + months_after
-        months_saved = max(term_months - total_months, 0)
-        
-        interest_saved = max(base_total_interest - total_interest, 0.0)
-        
-        return (
-            "Стратегия: сокращаем срок, платёж остаётся прежним.\n\n"
-            f"Базовый платёж: {base_payment:,.2f} {currency}\n"
-            f"Остаток перед досрочным: {balance_before_extra:,.2f} {currency}\n"
-            f"Остаток после досрочного: {balance_after_extra:,.2f} {currency}\n"
-            f"Новый срок: {total_months} мес (экономия {months_saved} мес)\n"
-            f"Проценты по графику: {base_total_interest:,.2f} {currency}\n"
-            f"Проценты с учётом досрочного: {total_interest:,.2f} {currency}\n"
-            f"Экономия на процентах: {interest_saved:,.2f} {currency}\n"
-            f"Всего выплатите: {total_paid:,.2f} {currency}"
-        )
-    
-    except ValueError as e:
-        logger.error(f"early_repayment_calculator error: {e}")
-        return f"Ошибка в расчёте: {e}"
+    return calculate_early_repayment(
+        loan_amount, annual_rate, term_months, early_payment, month_number, strategy, currency
+    )
 
 
 if __name__ == "__main__":
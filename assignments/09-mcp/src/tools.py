@@ -7,10 +7,37 @@
 import json
 import logging
 from langchain_core.tools import tool
+try:
+    import orjson
+except ImportError:  # orjson не установлен — используем стандартный json
+    orjson = None
 import rag
 
 logger = logging.getLogger(__name__)
 
+
+def _dumps(payload: dict) -> str:
+    """Сериализует ответ инструмента в JSON с кириллицей как есть."""
+    if orjson is not None:
+        # orjson сразу пишет UTF-8 и заметно быстрее на больших page_content
+        return orjson.dumps(payload, default=str).decode("utf-8")
+    return json.dumps(payload, ensure_ascii=False)
+
+
+def _doc_to_dict(doc) -> dict:
+    """Преобразует документ в источник для ответа rag_search."""
+    meta = doc.metadata
+    source_data = {
+        "source": meta.get("source", "Unknown"),
+        "page_content": doc.page_content  # Полный текст документа
+    }
+    # page только для PDF (у JSON документов его нет)
+    page = meta.get("page")
+    if page is not None:
+        source_data["page"] = page
+    return source_data
+
+
 @tool
 def rag_search(query: str) -> str:
     """
@@ -26,24 +53,14 @@ def rag_search(query: str) -> str:
         documents = rag.retrieve_documents(query)
         
         if not documents:
-            return json.dumps({"sources": []}, ensure_ascii=False)
+            return _dumps({"sources": []})
         
         # Формируем структурированный ответ для агента
-        sources = []
-        for doc in documents:
-            source_data = {
-                "source": doc.metadata.get("source", "Unknown"),
-                "page_content": doc.page_content  # Полный текст документа
-            }
-            # page только для PDF (у JSON документов его нет)
-            if "page" in doc.metadata:
-                source_data["page"] = doc.metadata["page"]
-            sources.append(source_data)
+        sources = [_doc_to_dict(doc) for doc in documents]
         
-        # ensure_ascii=False для корректной кириллицы
-        return json.dumps({"sources": sources}, ensure_ascii=False)
+        return _dumps({"sources": sources})
         
     except Exception as e:
         logger.error(f"Error in rag_search: {e}", exc_info=True)
-        return json.dumps({"sources": []}, ensure_ascii=False)
+        return _dumps({"sources": []})
 